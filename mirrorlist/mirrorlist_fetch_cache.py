@@ -0,0 +1,201 @@
+#!/usr/bin/python
+#
+# Licensed under the MIT/X11 license
+
+"""
+Fetch the mirrorlist caches written by mm2_refresh_mirrorlist_cache --delta
+on the mirrorlist nodes.
+
+The manifest of the caches is read first, and only the delta files the node
+misses are downloaded.  The whole pickle file is only downloaded when the
+generation the node has is missing or too old for the deltas available,
+or when the node would have more deltas to replay than the source keeps.
+mirrorlist_server.py loads the pickle file followed by the deltas, and on
+SIGHUP applies the new deltas to the caches it has loaded.
+"""
+
+# standard library modules in alphabetical order
+import cPickle as pickle
+import getopt
+import hashlib
+import json
+import os
+import signal
+import sys
+import urllib2
+
+# see the delta distribution in mirrormanager2/lib/mirrorlist.py
+DELTA_VERSION = 1
+
+# can be overridden on the command line
+cachefile = '/var/lib/mirrormanager/mirrorlist_cache.pkl'
+source = None
+pidfile = None
+max_deltas = None
+
+
+def read_source(source, name):
+    """ Return the content of the file `name` of the source, a URL or a
+    directory. """
+    if source.startswith(('http://', 'https://')):
+        stream = urllib2.urlopen('%s/%s' % (source.rstrip('/'), name))
+    else:
+        stream = open(os.path.join(source, name), 'r')
+    try:
+        return stream.read()
+    finally:
+        stream.close()
+
+
+def write_file(filename, content):
+    tmpfile = '%s.tmp' % filename
+    f = open(tmpfile, 'w')
+    f.write(content)
+    f.close()
+    os.rename(tmpfile, filename)
+
+
+def read_manifest(filename):
+    """ Return the manifest of the pickle file, or None if there is none or
+    the pickle file is missing. """
+    if not os.path.exists(filename):
+        return None
+    try:
+        f = open('%s.manifest' % filename, 'r')
+        manifest = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        return None
+    if manifest.get('version') != DELTA_VERSION:
+        return None
+    return manifest
+
+
+def latest_generation(manifest):
+    return max([manifest['generation']] + manifest['deltas'])
+
+
+def can_follow(local, remote):
+    """ Whether the deltas of the remote manifest lead from the caches of
+    the local one to the latest generation. """
+    have = latest_generation(local)
+    if local['generation'] == remote['generation']:
+        return local['checksum'] == remote['checksum']
+    if local['generation'] > remote['generation'] \
+            or have > latest_generation(remote):
+        # the caches were built again from scratch
+        return False
+    return all(
+        g in remote['deltas']
+        for g in range(have + 1, latest_generation(remote) + 1))
+
+
+def fetch_caches(source, filename, fetch=read_source, max_deltas=None):
+    """ Bring the pickle file and its deltas up to date with the source.
+    The chain of deltas is kept within max_deltas, by default the number of
+    deltas the source keeps: past it the whole pickle file is downloaded
+    again.  Returns the names of the files downloaded. """
+    basename = os.path.basename(filename)
+    remote = json.loads(fetch(source, '%s.manifest' % basename))
+    if remote.get('version') != DELTA_VERSION:
+        raise ValueError('Unsupported manifest version %r' % (
+            remote.get('version')))
+    local = read_manifest(filename)
+    if max_deltas is None:
+        max_deltas = max(1, len(remote['deltas']))
+
+    fetched = []
+    if local is None or not can_follow(local, remote) \
+            or latest_generation(remote) - local['generation'] > max_deltas:
+        content = fetch(source, basename)
+        checksum = hashlib.sha256(content).hexdigest()
+        if checksum != remote['checksum']:
+            # written again meanwhile, the next run gets it
+            raise ValueError('%s does not match its manifest' % basename)
+        write_file(filename, content)
+        local = dict(
+            version=DELTA_VERSION, generation=remote['generation'],
+            checksum=checksum, deltas=[])
+        fetched.append(basename)
+
+    for g in range(latest_generation(local) + 1,
+                   latest_generation(remote) + 1):
+        name = '%s.delta-%d' % (basename, g)
+        content = fetch(source, name)
+        delta = pickle.loads(content)
+        if delta.get('generation') != g \
+                or delta.get('base_generation') != g - 1:
+            raise ValueError('%s does not match its name' % name)
+        write_file(os.path.join(os.path.dirname(filename), name), content)
+        local['deltas'].append(g)
+        fetched.append(name)
+
+    # the deltas of an older pickle file
+    dirname = os.path.dirname(os.path.abspath(filename))
+    prefix = '%s.delta-' % basename
+    for name in os.listdir(dirname):
+        if name.startswith(prefix) and name[len(prefix):].isdigit() \
+                and int(name[len(prefix):]) not in local['deltas']:
+            os.unlink(os.path.join(dirname, name))
+
+    if fetched:
+        write_file('%s.manifest' % filename, json.dumps(local))
+    return fetched
+
+
+def usage():
+    print 'usage: %s -s SOURCE [-c CACHE] [-p PIDFILE] [-m MAX_DELTAS]' % (
+        sys.argv[0])
+    print '  -s, --source: URL or directory holding the caches to fetch'
+    print '  -c, --cache: local pickle file (default=%s)' % cachefile
+    print '  -p, --pidfile: mirrorlist_server.py to send SIGHUP to when ' \
+        'something was fetched'
+    print '  -m, --max-deltas: deltas replayed at most before the pickle ' \
+        'file is fetched again (default=as many as the source keeps)'
+
+
+def parse_args():
+    global cachefile
+    global source
+    global pidfile
+    global max_deltas
+    opts, args = getopt.getopt(
+        sys.argv[1:], "s:c:p:m:h",
+        ["source=", "cache=", "pidfile=", "max-deltas=", "help"]
+    )
+    for option, argument in opts:
+        if option in ("-s", "--source"):
+            source = argument
+        if option in ("-c", "--cache"):
+            cachefile = argument
+        if option in ("-p", "--pidfile"):
+            pidfile = argument
+        if option in ("-m", "--max-deltas"):
+            max_deltas = int(argument)
+        if option in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+
+
+def main():
+    parse_args()
+    if source is None:
+        usage()
+        return 1
+    try:
+        fetched = fetch_caches(source, cachefile, max_deltas=max_deltas)
+    except Exception as err:
+        print 'Error fetching the caches from %s: %s' % (source, err)
+        return 1
+    for name in fetched:
+        print 'Fetched %s' % name
+    if fetched and pidfile is not None:
+        f = open(pidfile, 'r')
+        pid = int(f.read().strip())
+        f.close()
+        os.kill(pid, signal.SIGHUP)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,6 +8,7 @@
 from collections import defaultdict
 import datetime
 import getopt
+import hashlib
 import logging
 import logging.handlers
 import os
@@ -22,6 +23,7 @@ import sys
 from string import zfill, atoi
 import time
 import traceback
+import zlib
 
 try:
     import threading
@@ -768,76 +770,189 @@ def setup_netblocks(netblocks_file, asns_wanted=None):
     return tree
 
 
-def read_caches():
-    global mirrorlist_cache
-    global host_netblock_cache
-    global host_country_allowed_cache
-    global host_max_connections_cache
-    global repo_arch_to_directoryname
-    global repo_redirect
-    global country_continent_redirect_cache
-    global disabled_repositories
-    global host_bandwidth_cache
-    global host_country_cache
-    global file_details_cache
-    global hcurl_cache
-    global asn_host_cache
-    global location_cache
-    global netblock_country_cache
+# data key in the pickle file -> name of the global holding it
+cache_globals = {
+    'mirrorlist_cache': 'mirrorlist_cache',
+    'host_netblock_cache': 'host_netblock_cache',
+    'host_country_allowed_cache': 'host_country_allowed_cache',
+    'repo_arch_to_directoryname': 'repo_arch_to_directoryname',
+    'repo_redirect_cache': 'repo_redirect',
+    'country_continent_redirect_cache': 'country_continent_redirect_cache',
+    'disabled_repositories': 'disabled_repositories',
+    'host_bandwidth_cache': 'host_bandwidth_cache',
+    'host_country_cache': 'host_country_cache',
+    'file_details_cache': 'file_details_cache',
+    'hcurl_cache': 'hcurl_cache',
+    'asn_host_cache': 'asn_host_cache',
+    'location_cache': 'location_cache',
+    'netblock_country_cache': 'netblock_country_cache',
+    'host_max_connections_cache': 'host_max_connections_cache',
+}
+
+# generation and sha256 of the caches loaded, see the delta distribution
+# in mirrormanager2/lib/mirrorlist.py
+DELTA_VERSION = 1
+cache_generation = None
+cache_checksum = None
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_full_cache():
+    global cache_generation
+    global cache_checksum
 
     data = {}
     try:
         f = open(cachefile, 'r')
-        data = pickle.load(f)
+        content = f.read()
         f.close()
+        data = pickle.loads(content)
+        cache_generation = data.get('generation')
+        cache_checksum = sha256(content)
     except:
-        pass
+        cache_generation = None
+        cache_checksum = None
+    return data
 
-    if 'mirrorlist_cache' in data:
-        mirrorlist_cache = data['mirrorlist_cache']
-    if 'host_netblock_cache' in data:
-        host_netblock_cache = data['host_netblock_cache']
-    if 'host_country_allowed_cache' in data:
-        host_country_allowed_cache = data['host_country_allowed_cache']
-    if 'repo_arch_to_directoryname' in data:
-        repo_arch_to_directoryname = data['repo_arch_to_directoryname']
-    if 'repo_redirect_cache' in data:
-        repo_redirect = data['repo_redirect_cache']
-    if 'country_continent_redirect_cache' in data:
-        country_continent_redirect_cache = data[
-            'country_continent_redirect_cache']
-    if 'disabled_repositories' in data:
-        disabled_repositories = data['disabled_repositories']
-    if 'host_bandwidth_cache' in data:
-        host_bandwidth_cache = data['host_bandwidth_cache']
-    if 'host_country_cache' in data:
-        host_country_cache = data['host_country_cache']
-    if 'file_details_cache' in data:
-        file_details_cache = data['file_details_cache']
-    if 'hcurl_cache' in data:
-        hcurl_cache = data['hcurl_cache']
-    if 'asn_host_cache' in data:
-        asn_host_cache = data['asn_host_cache']
-    if 'location_cache' in data:
-        location_cache = data['location_cache']
-    if 'netblock_country_cache' in data:
-        netblock_country_cache = data['netblock_country_cache']
-    if 'host_max_connections_cache' in data:
-        host_max_connections_cache = data['host_max_connections_cache']
 
-    setup_continents()
+def delta_generations():
+    dirname, basename = os.path.split(os.path.abspath(cachefile))
+    prefix = '%s.delta-' % basename
+    generations = []
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        names = []
+    for name in names:
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            generations.append(int(name[len(prefix):]))
+    return sorted(generations)
+
+
+def apply_cache_changes(data, changes):
+    for key, change in changes.iteritems():
+        if change[0] == 'replace':
+            data[key] = change[1]
+        else:
+            # copy rather than update in place, the forked children may
+            # be using the current one
+            cache = dict(data.get(key, {}))
+            cache.update(change[1])
+            for k in change[2]:
+                cache.pop(k, None)
+            data[key] = cache
+
+
+def file_stamp(filename):
+    try:
+        st = os.stat(filename)
+    except (OSError, TypeError):
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+# what the caches and the trees loaded were built from, to only rebuild
+# what changed on SIGHUP
+cache_file_stamp = None
+netblocks_stamps = {}
+
+
+def read_cache_deltas(data):
+    """ Apply to the caches `data`, of the generation loaded, the deltas
+    written since.  Returns the keys of the caches changed, or None if the
+    deltas cannot be applied and the pickle file has to be read again. """
+    global cache_generation
+    global cache_checksum
+
+    if cache_generation is None:
+        return None
+    generations = [g for g in delta_generations() if g > cache_generation]
+    if not generations:
+        if file_stamp(cachefile) == cache_file_stamp:
+            # nothing new
+            return set()
+        # the cache file was written without delta
+        return None
+    if generations != range(cache_generation + 1, generations[-1] + 1):
+        return None
+
+    # applied on a copy, so the caches are left alone if a delta is wrong
+    new_data = dict(data)
+    changed = set()
+    generation = cache_generation
+    checksum = cache_checksum
+    for g in generations:
+        try:
+            f = open('%s.delta-%d' % (cachefile, g), 'r')
+            delta = pickle.load(f)
+            f.close()
+        except:
+            return None
+        if delta.get('version') != DELTA_VERSION \
+                or delta['base_generation'] != generation \
+                or delta['base_checksum'] != checksum \
+                or delta['generation'] != g \
+                or sha256(delta['payload']) != delta['payload_checksum']:
+            return None
+        changes = pickle.loads(zlib.decompress(delta['payload']))
+        apply_cache_changes(new_data, changes)
+        changed.update(changes)
+        generation = delta['generation']
+        checksum = delta['checksum']
+
+    data.update(new_data)
+    cache_generation = generation
+    cache_checksum = checksum
+    return changed
+
+
+def read_caches():
+    global cache_file_stamp
     global internet2_tree
     global global_tree
     global host_netblocks_tree
     global netblock_country_tree
 
-    internet2_tree = setup_netblocks(internet2_netblocks_file)
-    global_tree    = setup_netblocks(global_netblocks_file, asn_host_cache)
-    # host_netblocks_tree key is a netblock, value is a list of host IDs
-    host_netblocks_tree = setup_cache_tree(host_netblock_cache, 'hosts')
-    # netblock_country_tree key is a netblock, value is a single country string
-    netblock_country_tree = setup_cache_tree(
-        netblock_country_cache, 'country')
+    data = dict(
+        (key, globals()[name]) for key, name in cache_globals.iteritems())
+    changed = read_cache_deltas(data)
+    if changed is None:
+        cache_file_stamp = file_stamp(cachefile)
+        data = read_full_cache()
+        changed = set(data)
+        # on the mirrorlist nodes, the pickle file is followed by the
+        # deltas fetched since, see mirrorlist_fetch_cache.py
+        newer = read_cache_deltas(data)
+        if newer:
+            changed.update(newer)
+
+    for key in changed:
+        if key in cache_globals:
+            globals()[cache_globals[key]] = data[key]
+
+    setup_continents()
+
+    # the trees are only rebuilt when what they are built from changed
+    stamp = file_stamp(internet2_netblocks_file)
+    if netblocks_stamps.get('internet2') != stamp:
+        internet2_tree = setup_netblocks(internet2_netblocks_file)
+        netblocks_stamps['internet2'] = stamp
+    stamp = file_stamp(global_netblocks_file)
+    if netblocks_stamps.get('global') != stamp \
+            or 'asn_host_cache' in changed:
+        global_tree = setup_netblocks(global_netblocks_file, asn_host_cache)
+        netblocks_stamps['global'] = stamp
+    if 'host_netblock_cache' in changed:
+        # host_netblocks_tree key is a netblock, value is a list of host IDs
+        host_netblocks_tree = setup_cache_tree(host_netblock_cache, 'hosts')
+    if 'netblock_country_cache' in changed:
+        # netblock_country_tree key is a netblock, value is a single
+        # country string
+        netblock_country_tree = setup_cache_tree(
+            netblock_country_cache, 'country')
 
 
 def errordoc(metalink, message):
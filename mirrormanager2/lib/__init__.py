@@ -451,6 +451,24 @@ def get_category_directory(session):
     return query.all()
 
 
+def get_category_topdirs(session):
+    ''' Return the list of (category id, name of the top directory) of all
+    the categories in the database.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.Category.id,
+        model.Directory.name,
+    ).filter(
+        model.Category.topdir_id == model.Directory.id
+    ).order_by(
+        model.Category.id
+    )
+    return query.all()
+
+
 def get_product_by_name(session, p_name):
     ''' Return a product by its name.
 
@@ -746,6 +764,29 @@ def get_mirrors(
     return final_query.all()
 
 
+def get_host_up2date_counts(session):
+    ''' Return the list of (host id, number of HostCategoryDir, number of
+    them up2date) of the hosts having HostCategoryDir.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.HostCategory.host_id,
+        sqlalchemy.func.count(model.HostCategoryDir.id),
+        sqlalchemy.func.sum(sqlalchemy.case(
+            [(model.HostCategoryDir.up2date == True, 1)], else_=0)),
+    ).filter(
+        model.HostCategory.id == model.HostCategoryDir.host_category_id
+    ).group_by(
+        model.HostCategory.host_id
+    ).order_by(
+        model.HostCategory.host_id
+    )
+
+    return query.all()
+
+
 def get_user_sites(session, username):
     """ Return the list of sites the specified user is admin of.
     """
@@ -790,6 +831,28 @@ def get_directory_by_name(session, dirname):
     return query.first()
 
 
+def get_directory_ids_under(session, dirname):
+    ''' Return the list of (name, id) of the specified Directory and of all
+    the Directory below it.
+
+    :arg session: the session with which to connect to the database.
+    :arg dirname: the name of the top Directory, ie: the topdir of a
+        Category.
+
+    '''
+    query = session.query(
+        model.Directory.name,
+        model.Directory.id,
+    ).filter(
+        sqlalchemy.or_(
+            model.Directory.name == dirname,
+            model.Directory.name.like(dirname + '/%'),
+        )
+    )
+
+    return query.all()
+
+
 def get_file_detail(
         session, filename, directory_id, md5=False, sha1=False, sha256=False,
         sha512=False, size=False, timestamp=False):
@@ -850,6 +913,21 @@ def get_directories(session):
     return query.all()
 
 
+def get_directory_names(session):
+    ''' Return the name of all the Directory in the database, sorted.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.Directory.name
+    ).order_by(
+        model.Directory.name
+    )
+
+    return [row.name for row in query.all()]
+
+
 def get_directory_by_id(session, id):
     ''' Return a specified Directory via its identifier.
 
@@ -883,6 +961,143 @@ def get_hostcategorydir_by_hostcategoryid_and_path(
     return query.all()
 
 
+def get_hostcategorydir_by_hostcategoryid_and_suffixes(
+        session, host_category_id, suffixes):
+    ''' Return the HostCategoryDir of a HostCategory whose Directory name
+    ends with one of the suffixes specified, with their Directory loaded.
+
+    :arg session: the session with which to connect to the database.
+    :arg host_category_id: the identifier of the HostCategory.
+    :arg suffixes: a list of suffixes, ie: ['/repodata', '/iso'].
+
+    '''
+    query = session.query(
+        model.HostCategoryDir
+    ).join(
+        model.Directory,
+        model.HostCategoryDir.directory_id == model.Directory.id
+    ).filter(
+        model.HostCategoryDir.host_category_id == host_category_id
+    ).filter(
+        sqlalchemy.or_(*[
+            model.Directory.name.like('%' + suffix)
+            for suffix in suffixes
+        ])
+    ).options(
+        sqlalchemy.orm.contains_eager(model.HostCategoryDir.directory)
+    ).order_by(
+        model.Directory.name
+    )
+
+    return query.all()
+
+
+def get_hostcategorydirs_by_hostcategoryids(session, host_category_ids):
+    ''' Return the id, host_category_id, path, up2date, directory_id and
+    verified_ctime of all the HostCategoryDir of the HostCategory specified,
+    with the readable flag of their Directory (None if they have none).
+
+    :arg session: the session with which to connect to the database.
+    :arg host_category_ids: a list of HostCategory identifiers.
+
+    '''
+    query = session.query(
+        model.HostCategoryDir.id,
+        model.HostCategoryDir.host_category_id,
+        model.HostCategoryDir.path,
+        model.HostCategoryDir.up2date,
+        model.HostCategoryDir.directory_id,
+        model.HostCategoryDir.verified_ctime,
+        model.Directory.readable,
+    ).outerjoin(
+        model.Directory,
+        model.HostCategoryDir.directory_id == model.Directory.id
+    ).filter(
+        model.HostCategoryDir.host_category_id.in_(host_category_ids)
+    )
+
+    return query.all()
+
+
+def add_hostcategorydirs(session, hostcategorydirs):
+    ''' Insert HostCategoryDir in bulk.
+
+    :arg session: the session with which to connect to the database.
+    :arg hostcategorydirs: a list of dictionaries with the host_category_id,
+        path, up2date, directory_id and verified_ctime of the new rows.
+
+    '''
+    if hostcategorydirs:
+        session.execute(
+            model.HostCategoryDir.__table__.insert(), hostcategorydirs)
+
+
+def _case_by_id(values, else_=None):
+    ''' The SQL expression giving to each HostCategoryDir its value of the
+    dictionary specified, by HostCategoryDir identifier. '''
+    whens = dict(
+        (key, value) for key, value in values.items() if value is not None)
+    if not whens:
+        return else_
+    return sqlalchemy.case(
+        whens, value=model.HostCategoryDir.id, else_=else_)
+
+
+def set_hostcategorydirs_up2date(
+        session, hostcategorydir_ids, up2date, verified_ctimes=None,
+        chunk_size=500):
+    ''' Flag the HostCategoryDir specified as up2date or not with set-based
+    UPDATEs of at most chunk_size rows each.
+
+    :arg session: the session with which to connect to the database.
+    :arg hostcategorydir_ids: a list of HostCategoryDir identifiers.
+    :arg up2date: a boolean.
+    :arg verified_ctimes: for the HostCategoryDir flagged up2date, the
+        ctime of their Directory when the files checked were read, by
+        HostCategoryDir identifier.  Not the current one, which may have
+        changed since.
+
+    '''
+    verified_ctimes = verified_ctimes or {}
+    hostcategorydir_ids = list(hostcategorydir_ids)
+    for start in range(0, len(hostcategorydir_ids), chunk_size):
+        chunk = hostcategorydir_ids[start:start + chunk_size]
+        verified_ctime = None
+        if up2date:
+            verified_ctime = _case_by_id(dict(
+                (hcd_id, verified_ctimes.get(hcd_id)) for hcd_id in chunk))
+        session.query(
+            model.HostCategoryDir
+        ).filter(
+            model.HostCategoryDir.id.in_(chunk)
+        ).update({
+            model.HostCategoryDir.up2date: up2date,
+            model.HostCategoryDir.verified_ctime: verified_ctime,
+        }, synchronize_session=False)
+
+
+def set_hostcategorydirs_directory(session, directory_ids, chunk_size=500):
+    ''' Link the HostCategoryDir specified to their Directory with
+    set-based UPDATEs of at most chunk_size rows each.
+
+    :arg session: the session with which to connect to the database.
+    :arg directory_ids: the Directory identifier of each HostCategoryDir,
+        by HostCategoryDir identifier.
+
+    '''
+    hostcategorydir_ids = sorted(directory_ids)
+    for start in range(0, len(hostcategorydir_ids), chunk_size):
+        chunk = hostcategorydir_ids[start:start + chunk_size]
+        session.query(
+            model.HostCategoryDir
+        ).filter(
+            model.HostCategoryDir.id.in_(chunk)
+        ).update({
+            model.HostCategoryDir.directory_id: _case_by_id(dict(
+                (hcd_id, directory_ids[hcd_id]) for hcd_id in chunk)),
+        }, synchronize_session=False)
+
+
 def uploaded_config(session, host, config):
     ''' Update the configuration of a specific host. '''
     message = ''
@@ -994,13 +1209,10 @@ def uploaded_config(session, host, config):
     return message
 
 
-def query_directories(session):
-    ''' Return the list of Directory, Host, HostCategoryUrl and Site
-    information required by `refresh_mirrorlist_cache` to build the pickle
-    file.
-
-    :arg session: the session with which to connect to the database.
-
+def _query_directories(
+        session, directory_ids=None, host_ids=None, name_range=None):
+    ''' Return the query used by `query_directories` and
+    `iter_directories`.
     '''
     query = session.query(
         model.Directory.id.label('directory_id'),
@@ -1034,6 +1246,17 @@ def query_directories(session):
         model.HostCategoryUrl.private == False
     )
 
+    if directory_ids is not None:
+        query = query.filter(model.Directory.id.in_(directory_ids))
+    if host_ids is not None:
+        query = query.filter(model.Host.id.in_(host_ids))
+    if name_range is not None:
+        start, end = name_range
+        if start is not None:
+            query = query.filter(model.Directory.name >= start)
+        if end is not None:
+            query = query.filter(model.Directory.name < end)
+
     q1 = query.filter(
         model.HostCategoryDir.host_category_id == model.HostCategory.id
     ).filter(
@@ -1050,10 +1273,126 @@ def query_directories(session):
         q1.union(q2).subquery()
     ).order_by(
         'dname',
-        'hostid'
+        'hostid',
+        'id'
     )
 
-    return q.all()
+    return q
+
+
+def query_directories(
+        session, directory_ids=None, host_ids=None, name_range=None):
+    ''' Return the list of Directory, Host, HostCategoryUrl and Site
+    information required by `refresh_mirrorlist_cache` to build the pickle
+    file.
+
+    :arg session: the session with which to connect to the database.
+    :kwarg directory_ids: restrict the results to the Directory having
+        these identifiers.
+    :kwarg host_ids: restrict the results to the Host having these
+        identifiers.
+    :kwarg name_range: a tuple (start, end) restricting the results to the
+        Directory whose name is greater or equal to start and lower than
+        end, either of them can be None to leave the range open.
+
+    '''
+    return _query_directories(
+        session, directory_ids=directory_ids, host_ids=host_ids,
+        name_range=name_range).all()
+
+
+def iter_directories(
+        session, directory_ids=None, host_ids=None, name_range=None,
+        batch_size=10000):
+    ''' Yield the rows of `query_directories` as plain tuples, in the same
+    order, without loading them all in memory.
+
+    The rows are fetched by batches through a server-side cursor where the
+    database driver supports it (psycopg2, MySQLdb), the other drivers
+    buffer the results on the client side.
+
+    :arg session: the session with which to connect to the database.
+    :kwarg directory_ids: see `query_directories`.
+    :kwarg host_ids: see `query_directories`.
+    :kwarg name_range: see `query_directories`.
+    :kwarg batch_size: the number of rows fetched at once.
+
+    '''
+    query = _query_directories(
+        session, directory_ids=directory_ids, host_ids=host_ids,
+        name_range=name_range)
+    connection = session.connection().execution_options(
+        stream_results=True)
+    result = connection.execute(query.statement)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+    finally:
+        result.close()
+
+
+def query_host_settings(session):
+    ''' Return, for each HostCategoryUrl, the Host, Site and HostCategory
+    information `query_directories` depends on. `refresh_mirrorlist_cache`
+    uses it to find the hosts which changed since its last run.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.Host.id.label('hostid'),
+        model.Host.user_active,
+        model.Host.admin_active,
+        model.Host.private,
+        model.Host.country,
+        model.Host.internet2,
+        model.Host.internet2_clients,
+        model.Site.user_active.label('site_user_active'),
+        model.Site.admin_active.label('site_admin_active'),
+        model.Site.private.label('site_private'),
+        model.HostCategory.id.label('host_category_id'),
+        model.HostCategory.category_id,
+        model.HostCategory.always_up2date,
+        model.HostCategoryUrl.id.label('host_category_url_id'),
+        model.HostCategoryUrl.private.label('host_category_url_private'),
+    ).outerjoin(
+        model.Site, model.Host.site_id == model.Site.id
+    ).outerjoin(
+        model.HostCategory, model.HostCategory.host_id == model.Host.id
+    ).outerjoin(
+        model.HostCategoryUrl,
+        model.HostCategoryUrl.host_category_id == model.HostCategory.id
+    ).order_by(
+        model.Host.id,
+        model.HostCategory.id,
+        model.HostCategoryUrl.id
+    )
+
+    return query.all()
+
+
+def get_hostcategorydir_updated_since(session, since):
+    ''' Return the identifiers of the Directory and Host of the
+    HostCategoryDir created or updated since the specified date.
+
+    :arg session: the session with which to connect to the database.
+    :arg since: a datetime (UTC).
+
+    '''
+    query = session.query(
+        model.HostCategoryDir.directory_id,
+        model.HostCategory.host_id,
+    ).filter(
+        model.HostCategoryDir.host_category_id == model.HostCategory.id
+    ).filter(
+        model.HostCategoryDir.updated_on >= since
+    )
+
+    return query.all()
 
 
 def get_directory_exclusive_host(session):
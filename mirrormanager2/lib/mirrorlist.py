@@ -19,12 +19,20 @@
 # of Red Hat, Inc.
 #
 
+import contextlib
+import datetime
 import os
 import hashlib
+import json
+import multiprocessing
+import multiprocessing.pool
+import time
+import zlib
 import cPickle as pickle
 
 from IPy import IP
 import pprint
+import dns.exception
 import dns.resolver
 
 import mirrormanager2.lib
@@ -44,6 +52,31 @@ global_caches = dict(
     host_asn_cache = {},
     )
 
+# Profiling of the build: the time spent in each phase, as a list of
+# (name, seconds) in the order they ended, and the size of each of the caches
+# written by dump_caches(), keyed by name, when it is asked to measure them.
+build_report = dict(
+    phases = [],
+    sizes = {},
+    )
+
+
+def reset_build_report():
+    build_report['phases'] = []
+    build_report['sizes'] = {}
+
+
+@contextlib.contextmanager
+def timed_phase(name):
+    ''' Record in the build report the time spent in the block. Phases may
+    be nested, the time of the inner ones is then counted in the outer one.
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        build_report['phases'].append((name, time.time() - start))
+
 
 def parent_dir(path):
     return os.path.dirname(path)
@@ -87,40 +120,82 @@ def query_directory_exclusive_host(session):
     return cache
 
 
-def populate_directory_cache(session):
-    global global_caches
-    result = mirrormanager2.lib.query_directories(session)
+def setup_arch_name_cache(session):
+    cache = {}
+    for a in mirrormanager2.lib.get_arches(session):
+        cache[a.id] = a.name
+    return cache
 
-    directory_exclusive_hosts = query_directory_exclusive_host(session)
 
-    def setup_directory_repo_cache(session):
-        cache = {}
-        for r in mirrormanager2.lib.get_repositories(session):
-            if r.directory and r.version and r.arch:
-                cache[r.directory.id] = r
-        return cache
-    def setup_version_ordered_mirrorlist_cache(session):
-        cache = {}
-        for v in mirrormanager2.lib.get_versions(session):
-            cache[v.id] = v.ordered_mirrorlist
-        return cache
-    def setup_category_topdir_cache(session):
-        cache = {}
-        for c in mirrormanager2.lib.get_categories(session):
-            cache[c.id] = len(c.topdir.name) + 1  # include trailing /
-        return cache
+def setup_directory_repo_cache(session, arch_name_cache):
+    ''' Return a dict directory id -> (prefix, arch name, version id) of
+    the repository of the directory.
 
-    directory_repo_cache = setup_directory_repo_cache(session)
-    cat_dirs = mirrormanager2.lib.get_category_directory(session)
-    directory_category_cache = {}
-    for catdir in cat_dirs:
-        append_value_to_cache(
-            directory_category_cache, catdir.directory_id, catdir.category_id)
-    version_ordered_mirrorlist_cache = setup_version_ordered_mirrorlist_cache(
-        session)
-    category_topdir_cache = setup_category_topdir_cache(session)
+    Only the columns of the repositories are read, so their relations are
+    never loaded.
+    '''
+    cache = {}
+    for r in mirrormanager2.lib.get_repositories(session):
+        if r.directory_id is not None and r.version_id is not None \
+                and r.arch_id in arch_name_cache:
+            cache[r.directory_id] = (
+                r.prefix, arch_name_cache[r.arch_id], r.version_id)
+    return cache
+
+
+def setup_version_ordered_mirrorlist_cache(session):
+    cache = {}
+    for v in mirrormanager2.lib.get_versions(session):
+        cache[v.id] = v.ordered_mirrorlist
+    return cache
+
+
+def setup_category_topdir_cache(session):
+    cache = {}
+    for (category_id, topdir) in \
+            mirrormanager2.lib.get_category_topdirs(session):
+        cache[category_id] = len(topdir) + 1  # include trailing /
+    return cache
 
+
+def setup_directory_category_cache(session):
     cache = {}
+    for catdir in mirrormanager2.lib.get_category_directory(session):
+        append_value_to_cache(
+            cache, catdir.directory_id, catdir.category_id)
+    return cache
+
+
+def setup_directory_lookups(session):
+    ''' Return the lookup tables `build_directory_cache` relies on, so it
+    does not have to query the database.
+    '''
+    arch_name_cache = setup_arch_name_cache(session)
+    return dict(
+        directory_exclusive_hosts=query_directory_exclusive_host(session),
+        directory_repo_cache=setup_directory_repo_cache(
+            session, arch_name_cache),
+        version_ordered_mirrorlist_cache=(
+            setup_version_ordered_mirrorlist_cache(session)),
+        directory_category_cache=setup_directory_category_cache(session),
+        category_topdir_cache=setup_category_topdir_cache(session),
+    )
+
+
+def build_directory_cache(result, cache, repo_arch_to_directoryname, lookups):
+    ''' Fill `cache` with the rows of `query_directories` provided, as a
+    list or as an iterator such as the one of `iter_directories`.
+
+    The rows of a given directory must all be provided at once, sorted by
+    host.
+    '''
+    directory_exclusive_hosts = lookups['directory_exclusive_hosts']
+    directory_repo_cache = lookups['directory_repo_cache']
+    version_ordered_mirrorlist_cache = lookups[
+        'version_ordered_mirrorlist_cache']
+    directory_category_cache = lookups['directory_category_cache']
+    category_topdir_cache = lookups['category_topdir_cache']
+
     for (directory_id, directoryname, hostid, country, hcurl,
             siteprivate, hostprivate, i2, i2_clients) in result:
         if directoryname in directory_exclusive_hosts and \
@@ -138,12 +213,11 @@ def populate_directory_cache(session):
 
             repo = directory_repo_cache.get(directory_id)
 
-            if repo is not None and repo.arch is not None:
-                global_caches['repo_arch_to_directoryname'][
-                    (repo.prefix, repo.arch.name)] = directoryname
-                # WARNING - this is a query # fixme use cache
-                cache[directoryname][
-                    'ordered_mirrorlist'] = repo.version.ordered_mirrorlist
+            if repo is not None:
+                (prefix, arch, version_id) = repo
+                repo_arch_to_directoryname[(prefix, arch)] = directoryname
+                cache[directoryname]['ordered_mirrorlist'] = \
+                    version_ordered_mirrorlist_cache[version_id]
 
             numcats = len(directory_category_cache.get(directory_id, []))
             if numcats == 0:
@@ -179,27 +253,491 @@ def populate_directory_cache(session):
 
         append_value_to_cache(cache[directoryname]['byHostId'], hostid, hcurl)
 
-    global_caches['mirrorlist_cache'] = shrink(cache)
+    return cache
+
+
+def directory_name_ranges(session, parts):
+    ''' Split the directory names in `parts` ranges holding about the same
+    number of directories, as (start, end) tuples usable with
+    `query_directories`.
+    '''
+    names = mirrormanager2.lib.get_directory_names(session)
+    bounds = []
+    for part in range(1, parts):
+        idx = len(names) * part // parts
+        if idx > 0 and names[idx] not in bounds:
+            bounds.append(names[idx])
+    return zip([None] + bounds, bounds + [None])
+
+
+# The session and the lookups of a worker process of
+# `populate_directory_cache`, set up once by `_init_directory_cache_worker`
+_worker_state = {}
+
+
+def _init_directory_cache_worker(db_url):
+    ''' Open the connection to the database of a worker process, and load
+    the lookups shared by all the slices it builds.
+    '''
+    session = mirrormanager2.lib.create_session(db_url)
+    # The lookups are loaded before the rows are streamed, as some
+    # drivers cannot run a query while a server-side cursor is open
+    _worker_state['lookups'] = setup_directory_lookups(session)
+    session.close()
+    _worker_state['session'] = session
+
+
+def _build_directory_cache_slice(name_range):
+    ''' Build the directory cache for the directories in a name range.
+
+    Run in a worker process of `populate_directory_cache`, set up by
+    `_init_directory_cache_worker`.
+    '''
+    session = _worker_state['session']
+    try:
+        cache = {}
+        repo_arch_to_directoryname = {}
+        build_directory_cache(
+            mirrormanager2.lib.iter_directories(
+                session, name_range=name_range),
+            cache, repo_arch_to_directoryname, _worker_state['lookups'])
+    finally:
+        session.close()
+    return (cache, repo_arch_to_directoryname)
+
+
+def populate_directory_cache(session, workers=1, db_url=None):
+    ''' Build the directory cache.
+
+    :arg session: the session with which to connect to the database.
+    :kwarg workers: if greater than 1, the directories are split in name
+        ranges whose cache is built by a pool of as many processes, the
+        results being merged before being shrunk.
+    :kwarg db_url: the URL of the database the workers connect to, default
+        to the one `session` is bound to.
+
+    '''
+    global global_caches
+    cache = {}
+    repo_arch_to_directoryname = global_caches['repo_arch_to_directoryname']
+
+    if workers > 1:
+        if db_url is None:
+            db_url = session.get_bind().url
+        # More slices than workers, so a slow one does not hold the others
+        ranges = directory_name_ranges(session, workers * 4)
+        pool = multiprocessing.Pool(
+            processes=workers, initializer=_init_directory_cache_worker,
+            initargs=(db_url,))
+        try:
+            for slice_cache, slice_repo_arch in pool.imap_unordered(
+                    _build_directory_cache_slice, ranges):
+                cache.update(slice_cache)
+                repo_arch_to_directoryname.update(slice_repo_arch)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        lookups = setup_directory_lookups(session)
+        build_directory_cache(
+            mirrormanager2.lib.iter_directories(session),
+            cache, repo_arch_to_directoryname, lookups)
+
+    with timed_phase('shrink'):
+        global_caches['mirrorlist_cache'] = shrink(cache)
+
 
+#
+# Incremental build of the directory cache
+#
+# The rows returned by query_directories() and the (not shrunk) directory
+# cache of the previous run are kept in a state dict.  On the next run only
+# the directories whose rows may have changed are queried again and rebuilt:
+#  - the directories of the hosts whose settings (activity, privacy,
+#    country, host categories or urls...) changed,
+#  - the directories having a HostCategoryDir updated since the last run,
+#  - the directories whose categories or exclusive hosts changed.
+# Changes to the repositories, versions or categories trigger a full build,
+# as does a state older than the configured full rebuild interval.
+
+BUILD_STATE_VERSION = 1
+
+
+def read_build_state(filename):
+    ''' Load the state saved by the previous incremental build. '''
+    return read_pickle(filename, 'build state')
+
+
+def write_build_state(filename, state):
+    ''' Save the state of the incremental build for the next run. '''
+    write_pickle(filename, state, 'build state')
+
+
+def _digest(data):
+    return hashlib.sha1(repr(data)).hexdigest()
+
+
+def host_fingerprints(session):
+    ''' Return a dict host id -> digest of the settings of the host
+    `query_directories` depends on.
+    '''
+    rows = {}
+    for row in mirrormanager2.lib.query_host_settings(session):
+        append_value_to_cache(rows, row.hostid, tuple(row))
+    return dict(
+        (hostid, _digest(hostrows)) for hostid, hostrows in rows.iteritems())
+
+
+def directory_fingerprints(lookups):
+    ''' Return a dict whose keys are the directory ids, associated with
+    a digest of the categories of the directory, and the directory names,
+    associated with a digest of the exclusive hosts of the directory.
+    '''
+    exclusive_hosts = lookups['directory_exclusive_hosts']
+    fingerprints = {}
+    for directory_id, categories in \
+            lookups['directory_category_cache'].iteritems():
+        fingerprints[directory_id] = sorted(categories)
+    # exclusive hosts are stored by directory name
+    for dname, hostids in exclusive_hosts.iteritems():
+        fingerprints[dname] = sorted(hostids)
+    return dict(
+        (key, _digest(value)) for key, value in fingerprints.iteritems())
+
+
+def structure_fingerprint(session, lookups):
+    ''' Return a digest of the repositories, versions and categories. '''
+    repos = sorted(
+        (r.id, r.prefix, r.arch_id, r.version_id, r.directory_id)
+        for r in mirrormanager2.lib.get_repositories(session))
+    versions = sorted(lookups['version_ordered_mirrorlist_cache'].items())
+    topdirs = sorted(lookups['category_topdir_cache'].items())
+    return _digest((repos, versions, topdirs))
+
+
+def _chunks(items, size=500):
+    items = sorted(items)
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+def _sort_rows(rows):
+    # same order as query_directories: by host then host category url
+    rows.sort(key=lambda row: (row[2], row[4]))
+
+
+def populate_directory_cache_incremental(
+        session, state, full_rebuild_interval=None,
+        margin=datetime.timedelta(hours=1)):
+    ''' Build the directory cache reusing the work of the previous run.
+
+    :arg session: the session with which to connect to the database.
+    :arg state: the dict returned by `read_build_state`, it is updated in
+        place and should be saved with `write_build_state`.
+    :kwarg full_rebuild_interval: a timedelta, if the last full build is
+        older than this, a full build is done.
+    :kwarg margin: HostCategoryDir updated up to this long before the
+        previous run are considered as changed, to account for the
+        transactions not yet committed when it ran and for the clock
+        differences between the machines updating them.
+    :return: True if a full build was done, False otherwise.
+
+    '''
+    global global_caches
+    now = datetime.datetime.utcnow()
+    lookups = setup_directory_lookups(session)
+    hosts = host_fingerprints(session)
+    directories = directory_fingerprints(lookups)
+    structure = structure_fingerprint(session, lookups)
+
+    full = (
+        state.get('version') != BUILD_STATE_VERSION
+        or state.get('structure') != structure
+        or state.get('full_built_at') is None
+        or (full_rebuild_interval is not None
+            and now - state['full_built_at'] >= full_rebuild_interval)
+    )
 
-def name_to_ips(name):
-    result=[]
-    recordtypes=('A', 'AAAA')
-    for r in recordtypes:
+    if full:
+        rows_by_dir = {}
+        for row in mirrormanager2.lib.iter_directories(session):
+            append_value_to_cache(rows_by_dir, row[1], row)
+        dirty = set(rows_by_dir)
+        cache = {}
+        repo_arch_to_directoryname = {}
+        state['full_built_at'] = now
+    else:
+        rows_by_dir = state['rows']
+        cache = state['cache']
+        repo_arch_to_directoryname = state['repo_arch_to_directoryname']
+        dirty = set()
+
+        # Hosts whose settings changed: replace their rows everywhere
+        old_hosts = state['hosts']
+        dirty_hosts = set(
+            hostid for hostid in set(hosts) | set(old_hosts)
+            if hosts.get(hostid) != old_hosts.get(hostid))
+        if dirty_hosts:
+            for dname, rows in rows_by_dir.items():
+                kept = [row for row in rows if row[2] not in dirty_hosts]
+                if len(kept) != len(rows):
+                    rows_by_dir[dname] = kept
+                    dirty.add(dname)
+            for hostids in _chunks(dirty_hosts):
+                for row in mirrormanager2.lib.query_directories(
+                        session, host_ids=hostids):
+                    append_value_to_cache(rows_by_dir, row.dname, tuple(row))
+                    dirty.add(row.dname)
+
+        # Directories changed: replace all their rows
+        old_directories = state['directories']
+        dirty_dirs = set(
+            key for key in set(directories) | set(old_directories)
+            if directories.get(key) != old_directories.get(key))
+        since = state['built_at'] - margin
+        for (directory_id, host_id) in \
+                mirrormanager2.lib.get_hostcategorydir_updated_since(
+                    session, since):
+            dirty_dirs.add(directory_id)
+
+        if dirty_dirs:
+            directory_ids = set(
+                key for key in dirty_dirs if not isinstance(key, basestring))
+            dnames = set(
+                key for key in dirty_dirs if isinstance(key, basestring))
+            for dname, rows in rows_by_dir.iteritems():
+                if rows and rows[0][0] in directory_ids:
+                    dnames.add(dname)
+            for dname in dnames:
+                rows = rows_by_dir.pop(dname, [])
+                directory_ids.update(row[0] for row in rows)
+                dirty.add(dname)
+            for ids in _chunks(directory_ids):
+                for row in mirrormanager2.lib.query_directories(
+                        session, directory_ids=ids):
+                    append_value_to_cache(rows_by_dir, row.dname, tuple(row))
+                    dirty.add(row.dname)
+
+        repo_arch_to_directoryname = dict(
+            (key, dname)
+            for key, dname in repo_arch_to_directoryname.iteritems()
+            if dname not in dirty)
+
+    for dname in dirty:
+        cache.pop(dname, None)
+        rows = rows_by_dir.get(dname)
+        if not rows:
+            rows_by_dir.pop(dname, None)
+            continue
+        _sort_rows(rows)
+        build_directory_cache(
+            rows, cache, repo_arch_to_directoryname, lookups)
+
+    state.update(dict(
+        version=BUILD_STATE_VERSION,
+        generation=state.get('generation', 0) + 1,
+        built_at=now,
+        structure=structure,
+        hosts=hosts,
+        directories=directories,
+        rows=rows_by_dir,
+        cache=cache,
+        repo_arch_to_directoryname=repo_arch_to_directoryname,
+        dirty=len(dirty),
+    ))
+
+    global_caches['repo_arch_to_directoryname'] = dict(
+        repo_arch_to_directoryname)
+    with timed_phase('shrink'):
+        global_caches['mirrorlist_cache'] = shrink(dict(cache))
+    return full
+
+
+def diff_directory_caches(cache1, cache2):
+    ''' Return the sorted list of the directories whose entry differs
+    between the two directory caches provided.
+    '''
+    return sorted(
+        dname for dname in set(cache1) | set(cache2)
+        if cache1.get(dname) != cache2.get(dname))
+
+
+def lookup_name(name, timeout=None):
+    ''' Resolve the A and AAAA records of the specified name.
+
+    Returns a tuple (ips, ttl) where ips is the list of addresses found (as
+    strings) and ttl the smallest time-to-live of the answers.
+    Raises an exception if the resolution failed for another reason than
+    the name not having any such record (timeout, no nameserver...).
+    Both lookups together are limited to `timeout` seconds.
+    '''
+    resolver = dns.resolver.Resolver()
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    result = []
+    ttl = None
+    for r in ('A', 'AAAA'):
+        if deadline is not None:
+            resolver.lifetime = deadline - time.time()
+            if resolver.lifetime <= 0:
+                raise dns.exception.Timeout()
         try:
-            records = dns.resolver.query(name, r)
-            for rdata in records:
-                try:
-                    ip = IP(str(rdata))
-                    result.append(ip)
-                except:
-                    continue
+            records = resolver.query(name, r)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            continue
+        if ttl is None or records.rrset.ttl < ttl:
+            ttl = records.rrset.ttl
+        for rdata in records:
+            result.append(str(rdata))
+    return (result, ttl)
+
+
+def name_to_ips(name, timeout=None):
+    result = []
+    try:
+        ips, ttl = lookup_name(name, timeout=timeout)
+    except:
+        return result
+    for ip in ips:
+        try:
+            result.append(IP(ip))
         except:
             continue
     return result
 
 
-def populate_netblock_cache(cache, host):
+def read_pickle(filename, what='cache'):
+    ''' Load the pickle file specified, returns an empty dict if it does
+    not exist or cannot be read.
+    '''
+    if filename is None or not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as stream:
+            return pickle.load(stream)
+    except Exception as err:
+        print 'Error reading the %s (%s): %s' % (what, filename, err)
+        return {}
+
+
+def write_pickle(filename, data, what='cache'):
+    ''' Atomically replace the pickle file specified, returns whether it
+    was written.
+    '''
+    if filename is None:
+        return False
+    tmpfile = '%s.tmp' % filename
+    try:
+        with open(tmpfile, 'w') as stream:
+            pickle.dump(data, stream, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, filename)
+    except Exception as err:
+        print 'Error writing the %s (%s): %s' % (what, filename, err)
+        return False
+    return True
+
+
+def read_dns_cache(filename):
+    ''' Load the resolved netblock names saved by a previous run.
+
+    The cache is a dict keyed by name whose values are dicts with the
+    `ips` found and the time (epoch) at which they `expire`.
+    '''
+    return read_pickle(filename, 'DNS cache')
+
+
+def write_dns_cache(filename, cache):
+    ''' Save the resolved netblock names for the next run. '''
+    write_pickle(filename, cache, 'DNS cache')
+
+
+def resolve_names(
+        names, cache=None, workers=10, timeout=5, min_ttl=300,
+        resolver=lookup_name):
+    ''' Resolve concurrently all the names provided.
+
+    Names for which `cache` holds a non-expired entry are not looked up
+    again. The others are resolved using a pool of `workers` threads, each
+    lookup being limited to `timeout` seconds. When a lookup fails, the
+    entry of the cache is used even if it has expired. The entries of the
+    names no longer provided are dropped from the cache.
+
+    `cache` is updated in place and a dict name -> list of IPy.IP is
+    returned.
+
+    :arg names: an iterable of host names to resolve.
+    :kwarg cache: a dict as returned by `read_dns_cache`.
+    :kwarg workers: the maximum number of lookups running at once.
+    :kwarg timeout: the maximum time (in seconds) spent resolving one name.
+    :kwarg min_ttl: lower bound of the time during which a result is
+        reused, whatever the TTL of the DNS answer.
+    :kwarg resolver: the function doing the lookup, it is called with a
+        name and the timeout and returns a tuple (ips, ttl).
+
+    '''
+    if cache is None:
+        cache = {}
+    now = time.time()
+    names = set(names)
+    for name in set(cache) - names:
+        del cache[name]
+    to_resolve = [
+        name for name in names
+        if name not in cache or cache[name]['expires'] <= now
+    ]
+
+    def _resolve(name):
+        try:
+            return (name, resolver(name, timeout))
+        except Exception:
+            return (name, None)
+
+    if to_resolve:
+        pool = multiprocessing.pool.ThreadPool(
+            processes=max(1, min(workers, len(to_resolve))))
+        try:
+            results = pool.map(_resolve, to_resolve)
+        finally:
+            pool.close()
+            pool.join()
+
+        for name, result in results:
+            if result is None:
+                # Failed lookup, keep using the stale entry if there is one
+                continue
+            ips, ttl = result
+            cache[name] = {
+                'ips': ips,
+                'expires': now + max(ttl or 0, min_ttl),
+            }
+
+    resolved = {}
+    for name in names:
+        resolved[name] = []
+        for ip in cache.get(name, {}).get('ips', []):
+            try:
+                resolved[name].append(IP(ip))
+            except ValueError:
+                continue
+    return resolved
+
+
+def netblock_names(hosts):
+    ''' Return the set of HostNetblock that are names and not IPs. '''
+    names = set()
+    for host in hosts:
+        if not host.is_active():
+            continue
+        for n in list(host.netblocks):
+            try:
+                IP(n.netblock)
+            except ValueError:
+                names.add(n.netblock)
+    return names
+
+
+def populate_netblock_cache(cache, host, resolved_names=None):
     if host.is_active() and len(host.netblocks) > 0:
         for n in list(host.netblocks):
             try:
@@ -207,7 +745,11 @@ def populate_netblock_cache(cache, host):
                 ips = [ip]
             except ValueError:
                 # probably a string
-                ips = name_to_ips(n.netblock)
+                if resolved_names is not None \
+                        and n.netblock in resolved_names:
+                    ips = resolved_names[n.netblock]
+                else:
+                    ips = name_to_ips(n.netblock)
 
             for ip in ips:
                 append_value_to_cache(cache, ip, host.id)
@@ -326,7 +868,8 @@ def netblock_country_cache(session):
     return cache
 
 
-def populate_host_caches(session):
+def populate_host_caches(
+        session, dns_cache_file=None, dns_workers=10, dns_timeout=5):
     n = dict()
     ca = dict()
     b = dict()
@@ -334,8 +877,17 @@ def populate_host_caches(session):
     a = dict()
     mc = dict()
 
-    for host in list(mirrormanager2.lib.get_hosts(session)):
-        n = populate_netblock_cache(n, host)
+    hosts = list(mirrormanager2.lib.get_hosts(session))
+
+    # Resolve the netblocks given as host names all at once, up front
+    dns_cache = read_dns_cache(dns_cache_file)
+    resolved_names = resolve_names(
+        netblock_names(hosts), cache=dns_cache,
+        workers=dns_workers, timeout=dns_timeout)
+    write_dns_cache(dns_cache_file, dns_cache)
+
+    for host in hosts:
+        n = populate_netblock_cache(n, host, resolved_names)
         ca = populate_host_country_allowed_cache(ca, host)
         b = populate_host_bandwidth_cache(b, host)
         cc = populate_host_country_cache(cc, host)
@@ -351,12 +903,25 @@ def populate_host_caches(session):
     global_caches['host_max_connections_cache'] = mc
 
 
-def populate_all_caches(session):
-    populate_host_caches(session)
-    populate_directory_cache(session)
+def populate_all_caches(
+        session, build_state=None, full_rebuild_interval=None,
+        directory_workers=1, **kwargs):
+    with timed_phase('host_caches'):
+        populate_host_caches(session, **kwargs)
+    # includes the shrink phase
+    with timed_phase('directory_cache'):
+        if build_state is None:
+            populate_directory_cache(session, workers=directory_workers)
+        else:
+            populate_directory_cache_incremental(
+                session, build_state,
+                full_rebuild_interval=full_rebuild_interval)
 
 
-def dump_caches(session, filename):
+def collect_caches(session):
+    ''' Return the dict of caches saved in the pickle file read by the
+    mirrorlist server.
+    '''
     data = {
         'mirrorlist_cache': global_caches['mirrorlist_cache'],
         'host_netblock_cache': global_caches['host_netblock_cache'],
@@ -366,21 +931,237 @@ def dump_caches(session, filename):
         'host_max_connections_cache': global_caches['host_max_connections_cache'],
         'asn_host_cache': global_caches['host_asn_cache'], # yeah I misnamed this
         'repo_arch_to_directoryname': global_caches['repo_arch_to_directoryname'],
-        'repo_redirect_cache': repository_redirect_cache(session),
-        'country_continent_redirect_cache': country_continent_redirect_cache(session),
-        'disabled_repositories': disabled_repository_cache(session),
-        'file_details_cache': file_details_cache(session),
-        'hcurl_cache': hcurl_cache(session),
-        'location_cache': location_cache(session),
-        'netblock_country_cache': netblock_country_cache(session),
     }
+    for key, function in [
+            ('repo_redirect_cache', repository_redirect_cache),
+            ('country_continent_redirect_cache',
+                country_continent_redirect_cache),
+            ('disabled_repositories', disabled_repository_cache),
+            ('file_details_cache', file_details_cache),
+            ('hcurl_cache', hcurl_cache),
+            ('location_cache', location_cache),
+            ('netblock_country_cache', netblock_country_cache)]:
+        with timed_phase(key):
+            data[key] = function(session)
+    return data
+
+
+def cache_sizes(data):
+    ''' Return a dict key -> dict with the number of `entries` and the
+    serialized `bytes` of each of the caches in `data`.
+    '''
+    sizes = {}
+    for key, value in data.iteritems():
+        entries = len(value) if hasattr(value, '__len__') else 1
+        sizes[key] = dict(
+            entries=entries,
+            bytes=len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+        )
+    return sizes
+
+
+def phase_regressions(previous, current, max_increase, min_seconds=1.0):
+    ''' Compare the phases of two build reports.
+
+    :arg previous: the phases of the reference build, as (name, seconds).
+    :arg current: the phases of the new build, as (name, seconds).
+    :arg max_increase: the relative increase allowed (0.5 for 50%).
+    :kwarg min_seconds: increases smaller than this are ignored, so short
+        phases do not fail on noise.
+    :return: the list of (name, previous seconds, current seconds) of the
+        phases which took longer than allowed.
+
+    '''
+    def _totals(phases):
+        totals = {}
+        for name, seconds in phases:
+            totals[name] = totals.get(name, 0) + seconds
+        return totals
+
+    previous = _totals(previous)
+    regressions = []
+    for name, seconds in sorted(_totals(current).iteritems()):
+        if name not in previous:
+            continue
+        if seconds > previous[name] * (1 + max_increase) \
+                and seconds - previous[name] >= min_seconds:
+            regressions.append((name, previous[name], seconds))
+    return regressions
 
-    try:
-        f = open(filename, 'w')
-        pickle.dump(data, f)
-        f.close()
-        #print 'Pickle generated at %s' % filename
-    except Exception as err:
-        print 'Error generating the pickle (%s): %s' % (
-            filename, err)
-        pass
+
+#
+# Delta distribution of the caches
+#
+# Every pickle file written by dump_caches() carries a 'generation' number,
+# incremented at each run.  When asked to, dump_caches() also writes next to
+# it a delta file holding only the changes since the previous generation:
+#   <filename>.delta-<generation>
+# The delta is a pickled dict:
+#   version: DELTA_VERSION
+#   base_generation, base_checksum: the generation and the sha256 of the
+#       pickle file the delta applies to
+#   generation, checksum: the generation and the sha256 of the pickle file
+#       obtained once applied
+#   payload_checksum: the sha256 of the payload
+#   payload: the zlib compressed pickle of the changes, a dict key ->
+#       ('replace', value) or ('update', {updated items}, [deleted keys])
+# The mirrorlist server applies the deltas following the generation it has
+# loaded and falls back to reading the whole pickle file when one of them
+# is missing or does not match.
+#
+# A manifest is written along, <filename>.manifest, a JSON dict:
+#   version: DELTA_VERSION
+#   generation, checksum: the generation and the sha256 of the pickle file
+#   deltas: the generations of the delta files available
+# The mirrorlist nodes fetch it first (see mirrorlist_fetch_cache.py) and
+# only download the deltas they miss, the whole pickle file being
+# downloaded when the generation they have is missing or too old.
+
+DELTA_VERSION = 1
+
+
+def file_checksum(filename):
+    ''' Return the sha256 of the content of the file specified. '''
+    checksum = hashlib.sha256()
+    with open(filename) as stream:
+        for block in iter(lambda: stream.read(1024 * 1024), ''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def delta_filename(filename, generation):
+    return '%s.delta-%d' % (filename, generation)
+
+
+def manifest_filename(filename):
+    return '%s.manifest' % filename
+
+
+def delta_generations(filename):
+    ''' Return the sorted generations of the delta files of the pickle file
+    specified.
+    '''
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    prefix = '%s.delta-' % basename
+    generations = []
+    for name in os.listdir(dirname):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            generations.append(int(name[len(prefix):]))
+    return sorted(generations)
+
+
+def write_manifest(filename, generation, checksum):
+    ''' Atomically write the manifest of the pickle file specified, listing
+    its delta files.
+    '''
+    manifest = manifest_filename(filename)
+    tmpfile = '%s.tmp' % manifest
+    with open(tmpfile, 'w') as stream:
+        json.dump(dict(
+            version=DELTA_VERSION,
+            generation=generation,
+            checksum=checksum,
+            deltas=delta_generations(filename),
+        ), stream, sort_keys=True)
+    os.rename(tmpfile, manifest)
+
+
+def diff_caches(old, new):
+    ''' Return the changes turning the dict of caches `old` into `new`, in
+    the format of the delta payload.
+    '''
+    changes = {}
+    for key, value in new.iteritems():
+        if key == 'generation' or key not in old:
+            if key != 'generation':
+                changes[key] = ('replace', value)
+            continue
+        previous = old[key]
+        if previous == value:
+            continue
+        if isinstance(previous, dict) and isinstance(value, dict):
+            updated = dict(
+                (k, v) for k, v in value.iteritems()
+                if k not in previous or previous[k] != v)
+            deleted = [k for k in previous if k not in value]
+            changes[key] = ('update', updated, deleted)
+        else:
+            changes[key] = ('replace', value)
+    return changes
+
+
+def write_cache_delta(filename, base, base_checksum, changes, generation,
+                      checksum):
+    ''' Write the delta file of the `generation` of the caches.
+
+    :arg filename: the pickle file of the caches.
+    :arg base: the caches of the previous generation.
+    :arg base_checksum: the sha256 of the pickle file of `base`.
+    :arg changes: the changes returned by `diff_caches`.
+    :arg generation: the generation of the new caches.
+    :arg checksum: the sha256 of the new pickle file.
+
+    '''
+    payload = zlib.compress(
+        pickle.dumps(changes, pickle.HIGHEST_PROTOCOL))
+    write_pickle(delta_filename(filename, generation), {
+        'version': DELTA_VERSION,
+        'base_generation': base.get('generation', 0),
+        'base_checksum': base_checksum,
+        'generation': generation,
+        'checksum': checksum,
+        'payload_checksum': hashlib.sha256(payload).hexdigest(),
+        'payload': payload,
+    }, 'cache delta')
+
+
+def remove_old_deltas(filename, keep):
+    ''' Remove the delta files but the `keep` most recent ones. '''
+    for generation in delta_generations(filename)[:-keep or None]:
+        try:
+            os.unlink(delta_filename(filename, generation))
+        except OSError:
+            pass
+
+
+def dump_caches(
+        session, filename, delta=False, keep_deltas=10, measure_sizes=False):
+    ''' Save the caches in the pickle file read by the mirrorlist server.
+
+    :arg session: the session with which to connect to the database.
+    :arg filename: the pickle file to write.
+    :kwarg delta: if True, also write the delta against the previous
+        generation of the file, if any, and the manifest of the files.
+    :kwarg keep_deltas: the number of delta files kept, older ones are
+        removed.
+    :kwarg measure_sizes: if True, store the size of each cache in the
+        build report.
+    :return: the generation of the caches written.
+
+    '''
+    data = collect_caches(session)
+
+    base = {}
+    base_checksum = None
+    if delta and os.path.exists(filename):
+        with timed_phase('delta'):
+            base = read_pickle(filename)
+            base_checksum = file_checksum(filename)
+    data['generation'] = base.get('generation', 0) + 1
+
+    with timed_phase('pickle_dump'):
+        written = write_pickle(filename, data)
+    if written and delta:
+        with timed_phase('delta'):
+            checksum = file_checksum(filename)
+            if base:
+                write_cache_delta(
+                    filename, base, base_checksum, diff_caches(base, data),
+                    data['generation'], checksum)
+            remove_old_deltas(filename, keep_deltas)
+            # last, the nodes fetch the files it lists
+            write_manifest(filename, data['generation'], checksum)
+    if measure_sizes:
+        build_report['sizes'] = cache_sizes(data)
+
+    return data['generation']
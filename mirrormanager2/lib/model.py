@@ -240,10 +240,24 @@ class Host(BASE):
         )
 
     def set_not_up2date(self, session):
-        for hc in self.categories:
-            for hcd in hc.directories:
-                hcd.up2date = False
-                session.commit()
+        ''' Flag all the directories of the host as not up2date with a
+        single UPDATE of host_category_dir, instead of one per directory.
+        '''
+        host_categories = session.query(
+            HostCategory.id
+        ).filter(
+            HostCategory.host_id == self.id
+        )
+        session.query(
+            HostCategoryDir
+        ).filter(
+            HostCategoryDir.host_category_id.in_(host_categories.subquery())
+        ).update({
+            HostCategoryDir.up2date: False,
+            HostCategoryDir.verified_ctime: None,
+        }, synchronize_session=False)
+        # the objects loaded are expired by the commit, and read again
+        session.commit()
 
     def is_active(self):
         return self.admin_active \
@@ -499,6 +513,17 @@ class HostCategoryDir(BASE):
         sa.Boolean, default=True, nullable=False, index=True)
     directory_id = sa.Column(
         sa.Integer, sa.ForeignKey('directory.id'), nullable=True)
+    # Lets refresh_mirrorlist_cache only look at the rows changed since its
+    # previous run
+    updated_on = sa.Column(
+        sa.DateTime,
+        nullable=True,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow,
+        index=True)
+    # Directory.ctime of the master copy the crawler last verified this
+    # directory against, lets an incremental crawl skip unchanged directories
+    verified_ctime = sa.Column(sa.BigInteger, nullable=True)
 
     # Relations
     directory = relation(
@@ -23,28 +23,138 @@
 MirrorManager2 internal api to manage sync.
 '''
 
+import os
+import re
+import signal
 import subprocess
 import tempfile
+import threading
 
 
-def run_rsync(rsyncpath, extra_rsync_args=None):
-    tmpfile = tempfile.SpooledTemporaryFile()
+def rsync_filters(directories):
+    """ Return the rsync filter rules restricting a recursive listing to
+    the files and subdirectories of the directories given, their parents
+    being traversed without listing their content.
+
+    :arg directories: the paths of the directories, relative to the top
+        of the listing, '' for the top itself.
+
+    """
+    rules = []
+    parents = set()
+    for directory in sorted(set(d.strip('/') for d in directories)):
+        # the directory names are not patterns
+        directory = re.sub(r'([*?[\\])', r'\\\1', directory)
+        if not directory:
+            rules.append('+ /*')
+            continue
+        parts = directory.split('/')
+        for i in range(1, len(parts) + 1):
+            parent = '/'.join(parts[:i])
+            if parent not in parents:
+                parents.add(parent)
+                rules.append('+ /%s/' % parent)
+        rules.append('+ /%s/*' % directory)
+    rules.append('- *')
+    return rules
+
+
+class RsyncListing(object):
+    """ The output of rsync, read line by line while rsync runs.  Its
+    returncode is set once it was read to the end, or closed. """
+
+    def __init__(self, process, timeout=None, filters=None):
+        self.process = process
+        self.returncode = None
+        # the file of filter rules, removed with the listing
+        self.filters = filters
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self):
+        """ Kill rsync along with the shell running it. """
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # it exited already
+            pass
+
+    def readline(self):
+        line = self.process.stdout.readline()
+        if not line:
+            self._finish()
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def _finish(self):
+        if self.returncode is not None:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.process.stdout.close()
+        self.returncode = self.process.wait()
+        if self.filters is not None:
+            self.filters.close()
+
+    def close(self):
+        """ Stop rsync if the listing was not read to the end. """
+        if self.returncode is None and self.process.poll() is None:
+            self.kill()
+        self._finish()
+
+
+def run_rsync(rsyncpath, extra_rsync_args=None, timeout=None,
+              directories=None, io_timeout=None):
+    """ Run rsync on the path specified and return its listing, streamed
+    as rsync produces it, see RsyncListing.
+
+    :arg rsyncpath: the rsync url to list.
+    :arg extra_rsync_args: a string of options added to the command line.
+    :arg timeout: the seconds after which rsync is killed, with a
+        negative returncode.
+    :arg directories: only list the files of these directories, relative
+        to rsyncpath, instead of the whole tree.
+    :arg io_timeout: the seconds rsync waits for data or for the
+        connection to the daemon before giving up.
+
+    """
     cmd = "rsync --temp-dir=/tmp -r --exclude=.snapshot --exclude='*.~tmp~'"
+    filters = None
+    if directories is not None:
+        filters = tempfile.NamedTemporaryFile(prefix='rsync-filters-')
+        filters.write(''.join(
+            '%s\n' % rule for rule in rsync_filters(directories)))
+        filters.flush()
+        cmd += " --filter='merge %s'" % filters.name
+    if io_timeout is not None:
+        cmd += ' --timeout=%d' % max(1, io_timeout)
+        if rsyncpath.startswith('rsync://'):
+            cmd += ' --contimeout=%d' % max(1, io_timeout)
     if extra_rsync_args is not None:
         cmd += ' ' + extra_rsync_args
     cmd += ' ' + rsyncpath
     devnull = open('/dev/null', 'r+')
-    p = subprocess.Popen(
-        cmd,
-        shell=True,
-        stdin=devnull,
-        stdout=tmpfile,
-        stderr=devnull,
-        close_fds=True,
-        bufsize=-1
-    )
-    p.wait()
-    result = p.returncode
-    tmpfile.flush()
-    tmpfile.seek(0)
-    return (result, tmpfile)
+    try:
+        # the shell in its own session, to kill rsync along with it: with
+        # setsid(1) rather than a preexec_fn, which is not safe to run in
+        # the child of a process with threads
+        p = subprocess.Popen(
+            ['setsid', '/bin/sh', '-c', cmd],
+            stdin=devnull,
+            stdout=subprocess.PIPE,
+            stderr=devnull,
+            close_fds=True,
+            bufsize=-1,
+        )
+    except:
+        if filters is not None:
+            filters.close()
+        raise
+    finally:
+        devnull.close()
+    return RsyncListing(p, timeout=timeout, filters=filters)
@@ -0,0 +1,1424 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the crawler.
+'''
+
+__requires__ = ['SQLAlchemy >= 0.7']
+import pkg_resources
+
+import argparse
+import BaseHTTPServer
+import collections
+import datetime
+import hashlib
+import httplib
+import imp
+import logging
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import mirrormanager2.lib
+import tests
+from mirrormanager2.lib import model
+
+# The crawler is a script, loaded as a module
+crawler = imp.load_source('mm2_crawler', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'utility',
+    'mm2_crawler'))
+
+
+def crawler_options(**kwargs):
+    """ Return the options of the crawler, the defaults updated with the
+    values given. """
+    options = crawler.parse_args([])
+    for key, value in kwargs.items():
+        setattr(options, key, value)
+    return options
+
+
+class FakeSocket(object):
+    """ The socket of FakeFTP. """
+
+    def settimeout(self, timeout):
+        pass
+
+
+class FakeFTP(object):
+    """ An FTP connection answering LIST -R with the lines given. """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.sock = FakeSocket()
+        self.timeout = None
+        self.path = None
+
+    def cwd(self, path):
+        self.path = path
+
+    def retrlines(self, command, callback):
+        for line in self.lines:
+            callback(line)
+
+
+# An Apache index of a directory of source packages
+AUTOINDEX_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'testdata', 'pub',
+    'fedora', 'linux', 'releases', '20', 'Fedora', 'source', 'SRPMS')
+
+
+class FakeResponse(object):
+    """ The response of http_get. """
+
+    def __init__(self, status, body, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+class ListHandler(logging.Handler):
+    """ Keeps the messages logged. """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the files of a MirrorServer, with keep-alive. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # idle keep-alive connections are closed after this many seconds
+        self.timeout = self.server.idle_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def respond(self, with_body):
+        server = self.server
+        server.requests.append((self.command, self.path, self.client_address))
+        time.sleep(server.delay)
+        content = ''
+        if self.path in server.redirects:
+            self.send_response(302)
+            self.send_header('Location', server.redirects[self.path])
+        elif self.path in server.files:
+            self.send_response(200)
+            content = server.files[self.path]
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(content)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ An HTTP mirror on localhost, serving the files given by path, and
+    redirecting the paths of redirects.  Each response waits for `delay`
+    seconds. """
+
+    daemon_threads = True
+
+    def __init__(self, files=None, redirects=None, delay=0,
+                 idle_timeout=None):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), MirrorHandler)
+        self.files = files or {}
+        self.redirects = redirects or {}
+        self.delay = delay
+        self.idle_timeout = idle_timeout
+        # (method, path, client address)
+        self.requests = []
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.thread = threading.Thread(
+            target=self.serve_forever, kwargs=dict(poll_interval=0.05))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MMCrawlertests(tests.Modeltests):
+    """ Crawler tests. """
+
+    def _create_host_data(self):
+        """ Create a host carrying the Fedora Linux category, whose top
+        directory is pub/fedora/linux/releases. """
+        tests.create_base_items(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_hostcategory(self.session)
+        for name in [
+                'pub/fedora/linux/releases/20/Fedora',
+                'pub/fedora/linux/releases/20/Fedora/x86_64',
+                'pub/fedora/linux/releases/21/Everything']:
+            self.session.add(model.Directory(name=name, readable=True))
+        self.session.commit()
+
+    def _create_mirror_data(self, url):
+        """ Give host 2 the Fedora Linux category at the url given, with
+        the directories 20/Fedora, 20/Fedora/x86_64 and 21/Everything
+        holding a 10 bytes a.rpm.  Returns the directories by name. """
+        self._create_host_data()
+        self.session.add(model.HostCategoryUrl(
+            host_category_id=3, url=url + '/pub/fedora/linux/releases'))
+        directories = {}
+        for path in ['20/Fedora', '20/Fedora/x86_64', '21/Everything']:
+            d = mirrormanager2.lib.get_directory_by_name(
+                self.session, 'pub/fedora/linux/releases/' + path)
+            d.files = {'a.rpm': {'size': '10', 'stat': 1400000000}}
+            d.ctime = 100
+            directories[d.name] = d
+            self.session.add(model.HostCategoryDir(
+                host_category_id=3, path=path, directory_id=d.id,
+                up2date=True, verified_ctime=50))
+        self.session.commit()
+        return directories
+
+    def test_add_indexed_parents(self):
+        """ Test that add_indexed_parents loads the parents missing from the
+        session in a single query.
+        """
+        self._create_host_data()
+        crawler.load_directory_index(self.session, crawler_options())
+        self.session.expunge_all()
+
+        hc = self.session.query(model.HostCategory).get(3)
+        directories = [
+            mirrormanager2.lib.get_directory_by_name(self.session, name)
+            for name in [
+                'pub/fedora/linux/releases/20/Fedora/x86_64',
+                'pub/fedora/linux/releases/21/Everything']]
+        host_category_dirs = dict(((hc, d), True) for d in directories)
+
+        with crawler.QueryCounter(self.session) as counter:
+            crawler.add_indexed_parents(
+                self.session, host_category_dirs, hc, directories)
+        self.assertEqual(counter.queries, 1)
+        self.assertEqual(
+            sorted((d.name, up2date)
+                   for (h, d), up2date in host_category_dirs.items()),
+            [('pub/fedora/linux/releases', None),
+             ('pub/fedora/linux/releases/20', None),
+             ('pub/fedora/linux/releases/20/Fedora', None),
+             ('pub/fedora/linux/releases/20/Fedora/x86_64', True),
+             ('pub/fedora/linux/releases/21', None),
+             ('pub/fedora/linux/releases/21/Everything', True)])
+
+        # The parents are in the session now
+        with crawler.QueryCounter(self.session) as counter:
+            crawler.add_indexed_parents(
+                self.session, host_category_dirs, hc, directories)
+        self.assertEqual(counter.queries, 0)
+
+    def test_host_shard(self):
+        """ Test that host_shard splits the hosts between the shards. """
+        shards = [crawler.host_shard(host_id, 3) for host_id in range(300)]
+        self.assertEqual(set(shards), set([0, 1, 2]))
+        # The same on every node
+        self.assertEqual(
+            shards, [crawler.host_shard(host_id, 3) for host_id in range(300)])
+        self.assertEqual(crawler.host_shard(12, 1), 0)
+
+    def test_schedule_hosts(self):
+        """ Test that schedule_hosts crawls the stale hosts first, then the
+        hosts whose last crawl succeeded, the longest first.
+        """
+        self._create_host_data()
+        tests.create_hostcategorydir(self.session)
+        now = datetime.datetime.utcnow()
+        hosts = self.session.query(model.Host).order_by(model.Host.id).all()
+        self.assertEqual([host.id for host in hosts], [1, 2, 3])
+        # Host 2 has a directory not up2date, its last crawl failed
+        hcd = self.session.query(model.HostCategoryDir).filter_by(
+            host_category_id=3).one()
+        hcd.up2date = False
+        hosts[0].last_crawled = now - datetime.timedelta(hours=1)
+        hosts[0].last_crawl_duration = 10
+        hosts[1].last_crawled = now - datetime.timedelta(hours=2)
+        hosts[1].last_crawl_duration = 600
+        hosts[2].last_crawled = None
+        self.session.commit()
+
+        def scheduled(**kwargs):
+            options = crawler_options(**kwargs)
+            return [
+                host.id for host in
+                crawler.schedule_hosts(self.session, options, hosts)]
+
+        self.assertEqual(scheduled(stale_hours=12), [3, 1, 2])
+
+        # The hosts succeeding, the longest crawl first
+        hcd.up2date = True
+        self.session.commit()
+        self.assertEqual(scheduled(stale_hours=12), [3, 2, 1])
+
+        # Host 2 is stale too
+        self.assertEqual(scheduled(stale_hours=1.5), [2, 3, 1])
+
+        # Only the hosts of the shard
+        for shard in range(2):
+            self.assertEqual(
+                scheduled(stale_hours=12, shards=2, shard=shard),
+                [host_id for host_id in [3, 2, 1]
+                 if crawler.host_shard(host_id, 2) == shard])
+
+    def test_crawl_journal(self):
+        """ Test that CrawlJournal resumes the crawl it records, including
+        when its last record was cut short by a crash.
+        """
+        self._create_host_data()
+        hc = self.session.query(model.HostCategory).get(3)
+        d = mirrormanager2.lib.get_directory_by_name(
+            self.session, 'pub/fedora/linux/releases/20/Fedora')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'journal.pkl')
+            generation = crawler.crawl_generation(crawler_options())
+
+            journal = crawler.CrawlJournal()
+            self.assertEqual(journal.open(filename, generation), ({}, {}))
+            journal.results(1, {})
+            journal.done(1, 0)
+            journal.results(2, {(hc, d): True}, {d.id: 42})
+            journal.stream.close()
+
+            # The crawl died before host 2 was synced
+            journal = crawler.CrawlJournal()
+            self.assertEqual(
+                journal.open(filename, generation, resume=True),
+                ({1: 0}, {2: [(3, d.id, True, 42)]}))
+            journal.done(2, 0)
+            journal.results(3, {(hc, d): False})
+            journal.stream.close()
+
+            # The last record is cut short
+            size = os.path.getsize(filename)
+            with open(filename, 'r+b') as stream:
+                stream.truncate(size - 5)
+            journal = crawler.CrawlJournal()
+            self.assertEqual(
+                journal.open(filename, generation, resume=True),
+                ({1: 0, 2: 0}, {}))
+            journal.close()
+
+            # The crawl ended, nothing to resume
+            journal = crawler.CrawlJournal()
+            self.assertEqual(
+                journal.open(filename, generation, resume=True), ({}, {}))
+            journal.results(1, {})
+            journal.stream.close()
+
+            # Not with other options
+            journal = crawler.CrawlJournal()
+            generation = crawler.crawl_generation(crawler_options(shards=2))
+            self.assertEqual(
+                journal.open(filename, generation, resume=True), ({}, {}))
+            journal.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_replay_journal(self):
+        """ Test that replay_journal syncs to the database the results of
+        the hosts not synced before the crawl died.
+        """
+        self._create_host_data()
+        d = mirrormanager2.lib.get_directory_by_name(
+            self.session, 'pub/fedora/linux/releases/20/Fedora')
+        self.assertEqual(
+            mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+                self.session, [3]), [])
+
+        # The directory 1000 was deleted since, the directory d changed
+        # since it was checked
+        d.ctime = 200
+        self.session.commit()
+        crawler.replay_journal(
+            self.session, crawler_options(),
+            {2: [(3, d.id, True, 100), (3, 1000, True, 100)]})
+
+        hcds = mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+            self.session, [3])
+        self.assertEqual(
+            [(hcd.directory_id, hcd.up2date, hcd.verified_ctime)
+             for hcd in hcds],
+            [(d.id, True, 100)])
+
+    def test_in_recheck_sample(self):
+        """ Test that in_recheck_sample checks every unchanged directory
+        once every 100/sample_percent days.
+        """
+        hcds = [model.HostCategoryDir(id=i) for i in range(1, 101)]
+        options = crawler_options(sample_percent=5)
+        for hcd in hcds:
+            self.assertEqual(
+                [day for day in range(100, 120)
+                 if crawler.in_recheck_sample(hcd, options, day)],
+                [day for day in range(100, 120) if (hcd.id + day) % 20 == 0])
+        # A different sample each day
+        self.assertEqual(
+            [len([hcd for hcd in hcds
+                  if crawler.in_recheck_sample(hcd, options, day)])
+             for day in range(3)],
+            [5, 5, 5])
+        self.assertNotEqual(
+            [hcd for hcd in hcds if crawler.in_recheck_sample(hcd, options, 0)],
+            [hcd for hcd in hcds if crawler.in_recheck_sample(hcd, options, 1)])
+
+        # No sample
+        options = crawler_options(sample_percent=0)
+        self.assertFalse(
+            [hcd for hcd in hcds if crawler.in_recheck_sample(hcd, options)])
+
+    def test_select_directories_to_scan(self):
+        """ Test that an incremental crawl only checks the directories
+        changed on the master since the host was last verified.
+        """
+        self._create_host_data()
+        hc = self.session.query(model.HostCategory).get(3)
+        for name, ctime, verified_ctime, up2date in [
+                ('pub/fedora/linux/releases/20/Fedora', 100, 100, True),
+                ('pub/fedora/linux/releases/20/Fedora/x86_64', 200, 100, True),
+                ('pub/fedora/linux/releases/21/Everything', 100, 100, False),
+                ]:
+            d = mirrormanager2.lib.get_directory_by_name(self.session, name)
+            d.ctime = ctime
+            self.session.add(model.HostCategoryDir(
+                host_category_id=hc.id, directory_id=d.id,
+                path=name[len('pub/fedora/linux/releases/'):],
+                up2date=up2date, verified_ctime=verified_ctime))
+        self.session.commit()
+
+        def scanned(**kwargs):
+            host_category_dirs = {}
+            hcds = crawler.select_directories_to_scan(
+                self.session, crawler_options(**kwargs), hc,
+                host_category_dirs)
+            return (
+                sorted(hcd.path for hcd in hcds),
+                sorted((d.name, up2date)
+                       for (h, d), up2date in host_category_dirs.items()))
+
+        self.assertEqual(
+            scanned(incremental=True, sample_percent=0),
+            (['20/Fedora/x86_64', '21/Everything'],
+             [('pub/fedora/linux/releases/20/Fedora', True)]))
+
+        # Everything in the sample
+        self.assertEqual(
+            scanned(incremental=True, sample_percent=100),
+            (['20/Fedora', '20/Fedora/x86_64', '21/Everything'], []))
+
+        # Not incremental
+        self.assertEqual(
+            scanned(),
+            (['20/Fedora', '20/Fedora/x86_64', '21/Everything'], []))
+
+    def test_fetch_sha256(self):
+        """ Test that fetch_sha256 only downloads the file again when it
+        changed since it was last fetched from the host.
+        """
+        url = 'http://mirror.example.com/pub/repodata/repomd.xml'
+        requests = []
+        responses = []
+
+        def http_get(hoststate, url, headers):
+            requests.append(headers)
+            return responses.pop(0)
+
+        orig = crawler.http_get
+        crawler.http_get = http_get
+        crawler.repomd_cache.clear()
+        crawler.repomd_stats.update(downloaded=0, not_modified=0)
+        try:
+            hoststate = crawler.hostState(host_id=1)
+            responses.append(FakeResponse(200, 'repomd', {
+                'ETag': '"1"',
+                'Last-Modified': 'Wed, 01 Jan 2014 10:00:00 GMT'}))
+            self.assertEqual(
+                crawler.fetch_sha256(hoststate, url),
+                hashlib.sha256('repomd').hexdigest())
+            self.assertEqual(requests.pop(0), {})
+
+            # Not modified: the sha256 of the cache
+            responses.append(FakeResponse(304, ''))
+            self.assertEqual(
+                crawler.fetch_sha256(hoststate, url),
+                hashlib.sha256('repomd').hexdigest())
+            self.assertEqual(requests.pop(0), {
+                'If-None-Match': '"1"',
+                'If-Modified-Since': 'Wed, 01 Jan 2014 10:00:00 GMT'})
+            self.assertEqual(
+                crawler.repomd_stats, dict(downloaded=1, not_modified=1))
+
+            # Modified, without validators this time
+            responses.append(FakeResponse(200, 'repomd 2'))
+            self.assertEqual(
+                crawler.fetch_sha256(hoststate, url),
+                hashlib.sha256('repomd 2').hexdigest())
+            requests.pop(0)
+            responses.append(FakeResponse(200, 'repomd 2'))
+            crawler.fetch_sha256(hoststate, url)
+            self.assertEqual(requests.pop(0), {})
+
+            # The cache is per host
+            responses.append(FakeResponse(200, 'repomd'))
+            crawler.fetch_sha256(crawler.hostState(host_id=2), url)
+            self.assertEqual(requests.pop(0), {})
+
+            # A 304 without cache is an error
+            crawler.repomd_cache.clear()
+            responses.append(FakeResponse(304, ''))
+            self.assertRaises(
+                crawler.HTTPUnknown, crawler.fetch_sha256, hoststate, url)
+        finally:
+            crawler.http_get = orig
+            crawler.repomd_cache.clear()
+
+    def test_load_host_category_dirs(self):
+        """ Test that load_host_category_dirs loads the results of a parked
+        host in bulk.
+        """
+        self._create_host_data()
+        directories = [
+            mirrormanager2.lib.get_directory_by_name(self.session, name)
+            for name in [
+                'pub/fedora/linux/releases/20/Fedora',
+                'pub/fedora/linux/releases/20/Fedora/x86_64',
+                'pub/fedora/linux/releases/21/Everything']]
+        results = [(3, directories[0].id, True, 10),
+                   (3, directories[1].id, None, 20),
+                   (3, directories[2].id, False, 30),
+                   (3, 1000, True, 40)]
+        self.session.expunge_all()
+
+        ctimes = {}
+        with crawler.QueryCounter(self.session) as counter:
+            host_category_dirs = crawler.load_host_category_dirs(
+                self.session, results, {}, ctimes)
+        self.assertEqual(counter.queries, 2)
+        self.assertEqual(
+            ctimes,
+            {directories[0].id: 10, directories[1].id: 20,
+             directories[2].id: 30})
+        self.assertEqual(
+            sorted((hc.id, d.name, up2date)
+                   for (hc, d), up2date in host_category_dirs.items()),
+            [(3, 'pub/fedora/linux/releases/20/Fedora', True),
+             (3, 'pub/fedora/linux/releases/20/Fedora/x86_64', None),
+             (3, 'pub/fedora/linux/releases/21/Everything', False)])
+
+        with crawler.QueryCounter(self.session) as counter:
+            crawler.load_host_category_dirs(self.session, [], {}, {})
+        self.assertEqual(counter.queries, 0)
+
+    def test_try_later_cap(self):
+        """ Test that the event loop gives up on a check the host asked to
+        try later MAX_TRY_LATER times.
+        """
+        self._create_host_data()
+        options = crawler_options(engine='events')
+        loop = crawler.CrawlLoop(self.session, options, {})
+        host = self.session.query(model.Host).get(2)
+        crawl = crawler.HostCrawl(host, options)
+        results = []
+
+        def check(hoststate):
+            raise crawler.TryLater()
+
+        def done(result):
+            results.append(result)
+
+        try:
+            check(None)
+        except crawler.TryLater:
+            exc = sys.exc_info()
+
+        def refuse():
+            crawl.in_flight += 1
+            loop.in_flight += 1
+            # the delay of the previous refusal is over
+            crawl.parked_until = 0
+            loop.complete(
+                crawl, crawl.get_hoststate(), check, done, (None, exc))
+
+        for i in range(crawler.MAX_TRY_LATER - 1):
+            refuse()
+            # checked again later
+            self.assertEqual(list(crawl.tasks), [(check, done)])
+            self.assertEqual(results, [])
+            crawl.tasks.popleft()
+        refuse()
+        self.assertEqual(list(crawl.tasks), [])
+        self.assertEqual(results, [None])
+        self.assertEqual(
+            crawl.stats.report()['try_later'], crawler.MAX_TRY_LATER)
+        self.assertFalse(crawl.stopped)
+        crawl.close()
+
+    def test_crawl_loop_dispatch(self):
+        """ Test that the event loop hands the checks of the hosts to the
+        workers in turn, within the limit of each host and the number of
+        workers, and runs their callbacks once they complete.
+        """
+        self._create_host_data()
+        options = crawler_options(engine='events', threads=3,
+                                  host_concurrency=2)
+        loop = crawler.CrawlLoop(self.session, options, {})
+        crawl1 = crawler.HostCrawl(
+            self.session.query(model.Host).get(1), options)
+        crawl2 = crawler.HostCrawl(
+            self.session.query(model.Host).get(2), options)
+        results = []
+
+        def task(name):
+            def check(hoststate):
+                return name
+
+            def done(result):
+                results.append(result)
+            return (check, done)
+
+        crawl1.tasks.extend([task('a1'), task('a2'), task('a3')])
+        crawl2.tasks.extend([task('b1')])
+        active = collections.deque([crawl1, crawl2])
+
+        loop.dispatch(active)
+        requests = []
+        while not loop.requests.empty():
+            requests.append(loop.requests.get())
+        # One check of each host in turn, three workers
+        self.assertEqual(
+            [(crawl, function(None)) for crawl, _, function, _ in requests],
+            [(crawl1, 'a1'), (crawl2, 'b1'), (crawl1, 'a2')])
+        self.assertEqual(loop.in_flight, 3)
+        self.assertEqual((crawl1.in_flight, crawl2.in_flight), (2, 1))
+
+        # No worker left, then no room left on host 1
+        loop.dispatch(active)
+        self.assertTrue(loop.requests.empty())
+        crawl, hoststate, function, callback = requests[1]
+        loop.complete(crawl, hoststate, function, callback,
+                      (function(hoststate), None))
+        self.assertEqual(results, ['b1'])
+        self.assertEqual((loop.in_flight, crawl2.in_flight), (2, 0))
+        self.assertEqual(crawl2.successes, 1)
+        self.assertTrue(crawl2.finished())
+        loop.dispatch(active)
+        self.assertTrue(loop.requests.empty())
+
+        crawl, hoststate, function, callback = requests[0]
+        loop.complete(crawl, hoststate, function, callback,
+                      (function(hoststate), None))
+        loop.dispatch(active)
+        crawl, hoststate, function, callback = loop.requests.get_nowait()
+        self.assertEqual(function(hoststate), 'a3')
+        self.assertEqual(list(crawl1.tasks), [])
+        self.assertFalse(crawl1.finished())
+        crawl1.close()
+        crawl2.close()
+
+    def test_crawl_loop_run(self):
+        """ Test that CrawlLoop.run crawls the hosts with the worker
+        threads, never checking more directories of a host at a time than
+        it allows, and returns their return codes.
+        """
+        self._create_host_data()
+        host = self.session.query(model.Host).get(3)
+        host.max_connections = 2
+        self.session.commit()
+        options = crawler_options(engine='events', threads=4,
+                                  host_concurrency=3)
+        loop = crawler.CrawlLoop(self.session, options, {})
+        lock = threading.Lock()
+        running = collections.Counter()
+        most = collections.Counter()
+        checked = []
+
+        def start_host(host):
+            crawl = crawler.HostCrawl(host, options)
+            host_id = host.id
+
+            def check(hoststate):
+                with lock:
+                    for key in (host_id, 'all'):
+                        running[key] += 1
+                        most[key] = max(most[key], running[key])
+                time.sleep(0.01)
+                with lock:
+                    for key in (host_id, 'all'):
+                        running[key] -= 1
+                return host_id
+
+            for i in range(10):
+                crawl.tasks.append((check, checked.append))
+            return crawl
+
+        loop.start_host = start_host
+        hosts = self.session.query(model.Host).order_by(model.Host.id).all()
+        self.assertEqual(loop.run(hosts), [0, 0, 0])
+        self.assertEqual(sorted(checked), [1] * 10 + [2] * 10 + [3] * 10)
+        # At most host_concurrency checks, max_connections for host 3
+        self.assertLessEqual(most[1], 3)
+        self.assertLessEqual(most[2], 3)
+        self.assertLessEqual(most[3], 2)
+        # The four workers were all busy
+        self.assertEqual(most['all'], 4)
+        self.assertEqual(loop.in_flight, 0)
+
+    def test_crawl_concurrency(self):
+        """ Test that a host asking to try later has its checks in flight
+        halved, then increased by one after as many checks succeeded, up to
+        its maximum.
+        """
+        self._create_host_data()
+        options = crawler_options(engine='events', host_concurrency=8)
+        crawl = crawler.HostCrawl(
+            self.session.query(model.Host).get(2), options)
+        self.assertEqual((crawl.max_limit, crawl.limit), (8, 8))
+
+        self.assertEqual(crawl.park(), 1)
+        self.assertEqual(crawl.limit, 4)
+        # The other checks in flight refused at the same time
+        self.assertEqual(crawl.park(), 0)
+        self.assertEqual(crawl.limit, 4)
+
+        for delay, limit in [(2, 2), (4, 1), (8, 1)]:
+            crawl.parked_until = 0
+            self.assertEqual(crawl.park(), delay)
+            self.assertEqual(crawl.limit, limit)
+        self.assertEqual(crawl.try_later_delay, 16)
+
+        limits = []
+        for i in range(40):
+            crawl.succeeded()
+            limits.append(crawl.limit)
+        # limit successes at each limit
+        self.assertEqual(
+            limits,
+            [2] + [2] + [3] * 3 + [4] * 4 + [5] * 5 + [6] * 6 + [7] * 7
+            + [8] * 13)
+        self.assertEqual(crawl.try_later_delay, 1)
+        crawl.close()
+
+    def test_connection_pool_limit(self):
+        """ Test that ConnectionPool keeps at most max_connections open,
+        closing the idle ones to other servers to make room.
+        """
+        pool = crawler.ConnectionPool(2, timeout=5)
+        conn1 = pool.acquire('http', 'a.example.com')
+        conn2 = pool.acquire('http', 'b.example.com')
+        self.assertEqual(pool.count, 2)
+
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(
+                pool.acquire('http', 'c.example.com')))
+        thread.daemon = True
+        thread.start()
+        thread.join(0.2)
+        # No room for a third connection
+        self.assertEqual(acquired, [])
+
+        # The idle connection to a.example.com is closed for it
+        pool.release(conn1, True)
+        thread.join(5)
+        self.assertEqual(len(acquired), 1)
+        self.assertEqual(acquired[0].host, 'c.example.com')
+        self.assertEqual(pool.count, 2)
+        self.assertEqual(pool.idle, {('http', 'a.example.com'): []})
+
+        # The idle connections are reused
+        pool.release(conn2, True)
+        self.assertTrue(pool.acquire('http', 'b.example.com') is conn2)
+        pool.release(conn2, False)
+        self.assertEqual(pool.count, 1)
+
+        # HTTPS
+        pool.release(acquired[0], False)
+        conn = pool.acquire('https', 'a.example.com:8443')
+        self.assertTrue(isinstance(conn, httplib.HTTPSConnection))
+        self.assertEqual((conn.host, conn.port), ('a.example.com', 8443))
+        self.assertEqual(conn.timeout, 5)
+        pool.release(conn, True)
+        pool.close()
+        self.assertEqual(pool.count, 0)
+
+    def test_connection_pool_redirect(self):
+        """ Test that a redirect to the same server reuses the connection,
+        a single one being allowed.
+        """
+        server = MirrorServer(
+            files={'/pub/a.rpm': '0123456789'},
+            redirects={'/pub/b.rpm': '/pub/a.rpm'})
+        try:
+            hoststate = crawler.hostState(
+                pool=crawler.ConnectionPool(1, timeout=5), timeout=5)
+            self.assertEqual(
+                crawler.check_head(
+                    hoststate, server.url + '/pub/b.rpm', {'size': '10'}, 0,
+                    True),
+                True)
+            self.assertEqual(
+                [(method, path) for method, path, client in server.requests],
+                [('HEAD', '/pub/b.rpm'), ('HEAD', '/pub/a.rpm')])
+            self.assertEqual(
+                len(set(client for _, _, client in server.requests)), 1)
+            self.assertTrue(hoststate.keepalives_available)
+            hoststate.close()
+        finally:
+            server.stop()
+
+    def test_connection_pool_idle_closed(self):
+        """ Test that a request on a keep-alive connection the server closed
+        meanwhile is retried on a new connection.
+        """
+        server = MirrorServer(
+            files={'/pub/a.rpm': '0123456789'}, idle_timeout=0.2)
+        try:
+            hoststate = crawler.hostState(
+                pool=crawler.ConnectionPool(1, timeout=5), timeout=5)
+            url = server.url + '/pub/a.rpm'
+            self.assertEqual(
+                crawler.check_head(hoststate, url, {'size': '10'}, 0, True),
+                True)
+            # The server closes the idle connection
+            time.sleep(0.5)
+            self.assertEqual(
+                crawler.check_head(hoststate, url, {'size': '10'}, 0, True),
+                True)
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(
+                len(set(client for _, _, client in server.requests)), 2)
+            self.assertEqual(hoststate.stats.report()['retries'], 1)
+            self.assertEqual(hoststate.pool.count, 1)
+            hoststate.close()
+        finally:
+            server.stop()
+
+    def test_crawl_deadline(self):
+        """ Test that the crawl of a host stops at its deadline, with the
+        timeout status, even if the server is slower than it.
+        """
+        server = MirrorServer(delay=5)
+        try:
+            self._create_mirror_data(server.url)
+            host = self.session.query(model.Host).get(2)
+            options = crawler_options(timeout_minutes=1 / 60.0)
+
+            start = time.time()
+            rc = crawler.worker(options, {'DB_URL': tests.DB_PATH}, host)
+            self.assertEqual(rc, 2)
+            self.assertTrue(time.time() - start < 4)
+            self.assertTrue(server.requests)
+        finally:
+            server.stop()
+
+        self.session.expire_all()
+        # The host is marked not up2date
+        self.assertEqual(
+            mirrormanager2.lib.get_host_up2date_counts(self.session),
+            [(2, 3, 0)])
+        stats = self.session.query(model.HostStats).filter_by(
+            host_id=2).one()
+        self.assertEqual(stats.data['status'], 2)
+
+    def test_crawl_parked_host(self):
+        """ Test that crawl_with_threads parks a host asking to try later,
+        resumes its crawl once the delay is over, and keeps what was
+        checked before it was parked.
+        """
+        directories = self._create_mirror_data('http://mirror2.localhost')
+        host = self.session.query(model.Host).get(2)
+        checked = []
+        loaded = []
+
+        def check_directory(d, hoststate, url):
+            checked.append(d.name)
+            if len(checked) == 2:
+                raise crawler.TryLater()
+            return True
+
+        def load_host_category_dirs(session, results, *args):
+            loaded.append(len(results))
+            return orig_load(session, results, *args)
+
+        orig_check, crawler.check_directory = \
+            crawler.check_directory, check_directory
+        orig_load, crawler.load_host_category_dirs = \
+            crawler.load_host_category_dirs, load_host_category_dirs
+        try:
+            start = time.time()
+            rcs = crawler.crawl_with_threads(
+                crawler_options(threads=1), {'DB_URL': tests.DB_PATH},
+                [host])
+        finally:
+            crawler.check_directory = orig_check
+            crawler.load_host_category_dirs = orig_load
+        self.assertEqual(rcs, [0])
+        # Parked for a second
+        self.assertTrue(time.time() - start >= 1)
+
+        # The directory refused is checked again, not the one before it
+        self.assertEqual(checked, [
+            'pub/fedora/linux/releases/20/Fedora',
+            'pub/fedora/linux/releases/20/Fedora/x86_64',
+            'pub/fedora/linux/releases/20/Fedora/x86_64',
+            'pub/fedora/linux/releases/21/Everything'])
+        # What was checked before the host was parked is loaded again
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(loaded[0], 0)
+        self.assertTrue(loaded[1] > 0)
+
+        self.session.expire_all()
+        hcds = self.session.query(model.HostCategoryDir).filter_by(
+            host_category_id=3).all()
+        self.assertEqual(
+            sorted((hcd.path, hcd.up2date, hcd.verified_ctime)
+                   for hcd in hcds
+                   if hcd.directory.name in directories),
+            [('20/Fedora', True, 100),
+             ('20/Fedora/x86_64', True, 100),
+             ('21/Everything', True, 100)])
+        stats = self.session.query(model.HostStats).filter_by(
+            host_id=2).one()
+        self.assertEqual(stats.data['status'], 0)
+        self.assertEqual(stats.data['try_later'], 1)
+
+    def test_record_crawl(self):
+        """ Test that record_crawl stores the duration and the statistics of
+        the crawl of a host, and that they are summed up at the end.
+        """
+        self._create_host_data()
+        del crawler.crawl_reports[:]
+        stats = crawler.CrawlStats()
+        stats.request('http', 1000)
+        stats.request('http', 500)
+        stats.add('retries')
+
+        crawler.record_crawl(
+            self.session, crawler_options(), 2, 0, 12.6, stats)
+        crawler.record_crawl(
+            self.session, crawler_options(), 1, 2, 3600, crawler.CrawlStats())
+        # A canary crawl is no estimate of the duration of a crawl
+        crawler.record_crawl(
+            self.session, crawler_options(canary=True), 2, 3, 1,
+            crawler.CrawlStats())
+
+        self.session.expire_all()
+        self.assertEqual(
+            self.session.query(model.Host).get(2).last_crawl_duration, 13)
+        self.assertEqual(
+            self.session.query(model.Host).get(1).last_crawl_duration, 3600)
+        rows = self.session.query(model.HostStats).order_by(
+            model.HostStats.id).all()
+        self.assertEqual(
+            [(row.host_id, row.type) for row in rows],
+            [(2, 'crawl'), (1, 'crawl'), (2, 'canary crawl')])
+        self.assertEqual(rows[0].data, {
+            'host': 'mirror2.localhost', 'status': 0, 'duration': 12.6,
+            'http_requests': 2, 'bytes': 1500, 'retries': 1})
+        self.assertEqual(
+            [(report['host_id'], report['status'])
+             for report in crawler.crawl_reports],
+            [(2, 0), (1, 2), (2, 3)])
+
+        handler = ListHandler()
+        crawler.logger.addHandler(handler)
+        try:
+            crawler.report_crawl_summary(crawler.crawl_reports, 60, slowest=1)
+        finally:
+            crawler.logger.removeHandler(handler)
+        self.assertEqual(handler.messages, [
+            'Crawled 3 hosts in 60.0s: 1 ok, 1 failed, 1 timed out',
+            'Timed out: mirror.localhost',
+            'Requests: http 2, 1500 bytes, 1 retries, 0 TryLater (0s)',
+            '  %-40s %7.1fs status 2, 0 requests'
+            % ('mirror.localhost', 3600),
+        ])
+        del crawler.crawl_reports[:]
+
+    def test_compare_rsync_listing(self):
+        """ Test that compare_rsync_listing matches the files of the rsync
+        listing of a category against the files expected in each directory.
+        """
+        listing = [
+            'drwxr-xr-x          4,096 2014/01/01 10:00:00 .\n',
+            '-rw-r--r--             10 2014/01/01 10:00:00 README\n',
+            'drwxr-xr-x          4,096 2014/01/01 10:00:00 20\n',
+            '-rw-r--r--           2048 2014/01/01 10:00:00 20/Fedora/a.rpm\n',
+            '-rw-r--r--              9 2014/01/01 10:00:00 20/Fedora/b.rpm\n',
+            'lrwxrwxrwx             11 2014/01/01 10:00:00 21/c.rpm\n',
+            'invalid line\n',
+            '-rw-r--r--              1 2014/01/01 10:00:00 21/d d.rpm\n',
+        ]
+
+        def expected():
+            return {
+                'README': (0, '10'),
+                '20/Fedora/a.rpm': (1, '2048'),
+                '20/Fedora/b.rpm': (1, '4096'),
+                '21/c.rpm': (2, '512'),
+                '21/d d.rpm': (2, '1'),
+            }
+
+        stats = crawler.CrawlStats()
+        self.assertEqual(
+            crawler.compare_rsync_listing(listing, expected(), 3, stats),
+            [True, False, True])
+        self.assertEqual(
+            stats.report(),
+            {'rsync_requests': 1, 'bytes': sum(len(l) for l in listing)})
+
+        # A file missing from a directory
+        self.assertEqual(
+            crawler.compare_rsync_listing(
+                [l for l in listing if 'README' not in l], expected(), 3),
+            [False, False, True])
+
+        # An empty listing tells nothing
+        self.assertEqual(
+            crawler.compare_rsync_listing([], expected(), 3), None)
+
+    def test_listing_comparator(self):
+        """ Test the ListingComparator class of the crawler. """
+        expected = {'a': (0, '1'), 'b/c': (1, '2')}
+        comparator = crawler.ListingComparator(expected, 2)
+        comparator.add('a', '-rw-r--r--', '1')
+        comparator.add('z', '-rw-r--r--', '1')
+        self.assertEqual(comparator.files, 2)
+        self.assertEqual(comparator.matched, 1)
+        # The matched files are removed
+        self.assertEqual(expected, {'b/c': (1, '2')})
+        self.assertEqual(comparator.result(), [True, False])
+
+    def _create_sync_data(self):
+        """ Create the HostCategoryDir of host 2 for the sync tests, return
+        the directories crawled, by name. """
+        self._create_host_data()
+        self.session.add(model.Directory(
+            name='pub/fedora/linux/releases/private', readable=False))
+        self.session.add(model.Directory(
+            name='pub/fedora/linux/extras/stuff', readable=True))
+        self.session.commit()
+        directories = {}
+        for name in [
+                'pub/fedora/linux/releases/20/Fedora',
+                'pub/fedora/linux/releases/20/Fedora/x86_64',
+                'pub/fedora/linux/releases/21/Everything',
+                'pub/fedora/linux/releases/private',
+                'pub/fedora/linux/extras/stuff']:
+            d = mirrormanager2.lib.get_directory_by_name(self.session, name)
+            d.ctime = 100
+            directories[name] = d
+        for hc_id, path, directory, up2date in [
+                # not linked to its directory yet
+                (3, '20/Fedora', None, False),
+                (3, '20/Fedora/x86_64',
+                 directories['pub/fedora/linux/releases/20/Fedora/x86_64'],
+                 True),
+                # gone from the master
+                (3, '19/Fedora', None, True),
+                (3, 'private',
+                 directories['pub/fedora/linux/releases/private'], True),
+                (4, 'stuff',
+                 directories['pub/fedora/linux/extras/stuff'], True),
+                ]:
+            self.session.add(model.HostCategoryDir(
+                host_category_id=hc_id, path=path, up2date=up2date,
+                directory_id=directory.id if directory else None,
+                verified_ctime=50))
+        self.session.commit()
+        return directories
+
+    def _hcds(self):
+        return sorted(
+            (row.host_category_id, row.path, row.up2date, row.directory_id,
+             row.verified_ctime)
+            for row in
+            mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+                self.session, [3, 4]))
+
+    def test_sync_hcds(self):
+        """ Test that sync_hcds stores the results of the crawl of a host
+        with set-based queries.
+        """
+        directories = self._create_sync_data()
+        host = self.session.query(model.Host).get(2)
+        hc = self.session.query(model.HostCategory).get(3)
+        host_category_dirs = {
+            (hc, directories['pub/fedora/linux/releases/20/Fedora']): True,
+            (hc, directories['pub/fedora/linux/releases/20/Fedora/x86_64']):
+            False,
+            (hc, directories['pub/fedora/linux/releases/21/Everything']):
+            True,
+        }
+        # UMDL bumped 21/Everything during the crawl
+        ctimes = dict(
+            (d.id, d.ctime) for (h, d) in host_category_dirs)
+        directories['pub/fedora/linux/releases/21/Everything'].ctime = 200
+        self.session.commit()
+
+        crawler.sync_hcds(
+            self.session, host, host_category_dirs, ctimes=ctimes)
+
+        fedora = directories['pub/fedora/linux/releases/20/Fedora'].id
+        self.assertEqual(self._hcds(), [
+            # historical
+            (3, '19/Fedora', False, None, None),
+            # marked up2date and linked to its directory
+            (3, '20/Fedora', True, fedora, 100),
+            (3, '20/Fedora/x86_64', False,
+             directories['pub/fedora/linux/releases/20/Fedora/x86_64'].id,
+             None),
+            # new, verified against the ctime it was checked with
+            (3, '21/Everything', True,
+             directories['pub/fedora/linux/releases/21/Everything'].id, 100),
+            # unreadable, left alone
+            (3, 'private', True,
+             directories['pub/fedora/linux/releases/private'].id, 50),
+            # the other category of the host, not crawled
+            (4, 'stuff', False,
+             directories['pub/fedora/linux/extras/stuff'].id, None),
+        ])
+        self.assertNotEqual(host.last_crawled, None)
+
+        # The number of queries does not depend on the number of
+        # directories
+        queries = []
+        for version, count in [(22, 5), (23, 50)]:
+            names = [
+                'pub/fedora/linux/releases/%d/%d' % (version, i)
+                for i in range(count)]
+            for name in names:
+                self.session.add(model.Directory(name=name, readable=True))
+            self.session.commit()
+            host = self.session.query(model.Host).get(2)
+            hc = self.session.query(model.HostCategory).get(3)
+            host_category_dirs = dict(
+                ((hc, d), True) for d in self.session.query(
+                    model.Directory).filter(model.Directory.name.in_(names)))
+            with crawler.QueryCounter(self.session) as counter:
+                crawler.sync_hcds(self.session, host, host_category_dirs)
+            queries.append(counter.queries)
+        self.assertEqual(queries[0], queries[1])
+        self.assertTrue(queries[0] <= 10, queries)
+        self.assertEqual(len(self._hcds()), 61)
+
+    def test_sync_hcds_canary(self):
+        """ Test that a canary sync only updates the directories checked.
+        """
+        directories = self._create_sync_data()
+        host = self.session.query(model.Host).get(2)
+        hc = self.session.query(model.HostCategory).get(3)
+        before = self._hcds()
+
+        crawler.sync_hcds(self.session, host, {
+            (hc, directories['pub/fedora/linux/releases/20/Fedora/x86_64']):
+            False,
+        }, canary=True)
+
+        self.assertEqual(host.last_crawled, None)
+        x86_64 = directories['pub/fedora/linux/releases/20/Fedora/x86_64']
+        self.assertEqual(
+            [row for row in self._hcds() if row not in before],
+            [(3, '20/Fedora/x86_64', False, x86_64.id, None)])
+        self.assertEqual(
+            [row for row in before if row not in self._hcds()],
+            [(3, '20/Fedora/x86_64', True, x86_64.id, 50)])
+
+    def test_canary_crawl(self):
+        """ Test that a canary crawl only checks and updates the repodata
+        and iso directories, leaving the other directories and the time of
+        the last crawl of the host as they were.
+        """
+        server = MirrorServer(files={
+            '/pub/fedora/linux/releases/20/Fedora/x86_64/repodata/'
+            'primary.xml.gz': '0123456789',
+        })
+        try:
+            self._create_mirror_data(server.url)
+            ids = {}
+            for name, filename, up2date in [
+                    ('20/Fedora/x86_64/repodata', 'primary.xml.gz', False),
+                    ('21/Everything/iso', 'boot.iso', True)]:
+                d = model.Directory(
+                    name='pub/fedora/linux/releases/' + name, readable=True,
+                    ctime=100)
+                d.files = {filename: {'size': '10', 'stat': 1400000000}}
+                self.session.add(d)
+                self.session.flush()
+                ids[name] = d.id
+                self.session.add(model.HostCategoryDir(
+                    host_category_id=3, path=name, directory_id=d.id,
+                    up2date=up2date, verified_ctime=None))
+            # gone from the master
+            self.session.add(model.HostCategoryDir(
+                host_category_id=3, path='19/Fedora', up2date=True))
+            self.session.commit()
+            before = self._hcds()
+            host = self.session.query(model.Host).get(2)
+
+            rc = crawler.worker(
+                crawler_options(canary=True, http_index=False),
+                {'DB_URL': tests.DB_PATH}, host)
+            self.assertEqual(rc, 0)
+        finally:
+            server.stop()
+
+        # Only the files of the repodata and iso directories were checked
+        self.assertEqual(
+            sorted(path for method, path, client in server.requests), [
+                '/pub/fedora/linux/releases/20/Fedora/x86_64/repodata/'
+                'primary.xml.gz',
+                '/pub/fedora/linux/releases/21/Everything/iso/boot.iso'])
+        self.session.expire_all()
+        self.assertEqual(
+            [row for row in self._hcds() if row not in before], [
+                (3, '20/Fedora/x86_64/repodata', True,
+                 ids['20/Fedora/x86_64/repodata'], 100),
+                (3, '21/Everything/iso', False,
+                 ids['21/Everything/iso'], None)])
+        self.assertEqual(len(self._hcds()), len(before))
+        self.assertEqual(
+            self.session.query(model.Host).get(2).last_crawled, None)
+        stats = self.session.query(model.HostStats).filter_by(
+            host_id=2).one()
+        self.assertEqual(stats.type, 'canary crawl')
+
+    def test_ftp_recursive_listing(self):
+        """ Test that FtpRecursiveListing feeds the files of a recursive FTP
+        listing to the ListingComparator, whatever the form of its lines
+        and headers.
+        """
+        expected = {
+            'README': (0, '10'),
+            '20/Fedora/x86_64/a.rpm': (1, '2048'),
+            '20/Fedora/x86_64/b.rpm': (1, '4096'),
+            '20/Fedora/x86_64/c.rpm': (1, '1'),
+            '21/Everything/d.rpm': (2, '512'),
+            '21/Everything/e.rpm': (2, '8'),
+        }
+        comparator = crawler.ListingComparator(expected, 3)
+        listing = crawler.FtpRecursiveListing(
+            comparator, '/pub/fedora/linux/releases')
+        for line in [
+                'total 8',
+                '-rw-r--r--    1 ftp      ftp            10 Jan 01  2014 README',
+                'drwxr-xr-x    3 ftp      ftp          4096 Jan 01  2014 20',
+                '',
+                './20/Fedora/x86_64:',
+                # 8 fields, no group
+                '-rw-r--r--    1 ftp          2048 Nov 12 10:05 a.rpm',
+                # numeric owner and group
+                '-rw-r--r--    1 1000     1000         4096 Nov 12 10:05 b.rpm',
+                'lrwxrwxrwx    1 ftp      ftp            20 Nov 12 10:05 '
+                'c.rpm -> ../../c-1.rpm',
+                '',
+                # an absolute header, an ISO date
+                '/pub/fedora/linux/releases/21/Everything:',
+                '-rw-r--r--    1 ftp      ftp           512 2014-11-12 10:05 '
+                'd.rpm',
+                '-rw-r--r--    1 ftp      ftp             9 2014-11-12 e.rpm',
+                ]:
+            listing(line)
+
+        self.assertEqual(listing.headers, 2)
+        self.assertEqual(listing.subdirectories, 1)
+        self.assertEqual(comparator.files, 6)
+        self.assertEqual(comparator.matched, 6)
+        # e.rpm has the wrong size, the size of the symlink c.rpm is ignored
+        self.assertEqual(comparator.result(), [True, True, False])
+
+        # The header of the category itself
+        listing('/pub/fedora/linux/releases:')
+        self.assertEqual(listing.directory, '')
+
+        # Names with spaces
+        listing('-rw-r--r--    1 ftp      ftp            10 Jan 01  2014 a b')
+        self.assertEqual(comparator.files, 7)
+
+    def test_try_ftp_recursive(self):
+        """ Test that try_ftp_recursive falls back to the listing of the
+        directories when the server does not list recursively or the
+        listing matches none of the files.
+        """
+        url = 'ftp://ftp.example.com/pub/fedora/linux/releases'
+
+        def try_ftp_recursive(lines):
+            hoststate = crawler.hostState()
+            hoststate.ftpconn['ftp.example.com'] = FakeFTP(lines)
+            expected = {
+                'README': (0, '10'),
+                '20/Fedora/a.rpm': (1, '2048'),
+            }
+            return crawler.try_ftp_recursive(hoststate, url, expected, 2)
+
+        self.assertEqual(
+            try_ftp_recursive([
+                '-rw-r--r--    1 ftp      ftp            10 Jan 01  2014 '
+                'README',
+                '/pub/fedora/linux/releases/20/Fedora:',
+                '-rw-r--r--    1 ftp      ftp          2048 Jan 01  2014 '
+                'a.rpm',
+            ]),
+            [True, True])
+
+        # A file missing
+        self.assertEqual(
+            try_ftp_recursive([
+                '-rw-r--r--    1 ftp      ftp            10 Jan 01  2014 '
+                'README',
+                './20/Fedora:',
+            ]),
+            [True, False])
+
+        # -R ignored, only the top directory listed
+        self.assertEqual(
+            try_ftp_recursive([
+                'drwxr-xr-x    3 ftp      ftp          4096 Jan 01  2014 20',
+            ]),
+            None)
+
+        # Headers the crawler does not understand
+        self.assertEqual(
+            try_ftp_recursive([
+                'releases-mirror/20/Fedora:',
+                '-rw-r--r--    1 ftp      ftp          2048 Jan 01  2014 '
+                'a.rpm',
+            ]),
+            None)
+
+    def test_parse_autoindex(self):
+        """ Test the parse_autoindex function of the crawler. """
+        with open(os.path.join(AUTOINDEX_PATH, 'l', 'index.html')) as stream:
+            listing = crawler.parse_autoindex(stream.read())
+        self.assertEqual(len(listing), 385)
+        self.assertEqual(listing['LibRaw-0.15.4-1.fc20.src.rpm'], '1.4M')
+        self.assertEqual(listing['langtable-0.0.23-1.fc20.src.rpm'], '624K')
+        # The sort links and the parent directory are not files
+        self.assertFalse([name for name in listing if '?' in name])
+        self.assertFalse([name for name in listing if '/' in name])
+
+        # Only subdirectories
+        with open(os.path.join(AUTOINDEX_PATH, 'index.html')) as stream:
+            self.assertEqual(crawler.parse_autoindex(stream.read()), {})
+
+        # Not a directory index
+        self.assertEqual(
+            crawler.parse_autoindex('<html><title>Mirror</title></html>'),
+            None)
+
+    def test_autoindex_size_matches(self):
+        """ Test the autoindex_size_matches function of the crawler. """
+        # Exact sizes
+        self.assertEqual(crawler.autoindex_size_matches('1234', '1234'), True)
+        self.assertEqual(
+            crawler.autoindex_size_matches('1235', '1234'), False)
+
+        # 624K is 638976 bytes, rounded to 1024 bytes
+        self.assertEqual(
+            crawler.autoindex_size_matches('638976', '624K'), True)
+        self.assertEqual(
+            crawler.autoindex_size_matches('638465', '624K'), True)
+        self.assertEqual(
+            crawler.autoindex_size_matches('639488', '624K'), True)
+        self.assertEqual(
+            crawler.autoindex_size_matches('638400', '624K'), False)
+        # Truncated rather than rounded
+        self.assertEqual(
+            crawler.autoindex_size_matches('639900', '624K'), None)
+        self.assertEqual(
+            crawler.autoindex_size_matches('640000', '624K'), False)
+
+        # 1.4M is 1468006 bytes, rounded to 104858 bytes
+        self.assertEqual(
+            crawler.autoindex_size_matches('1500000', '1.4M'), True)
+        self.assertEqual(
+            crawler.autoindex_size_matches('1400000', '1.4M'), False)
+        self.assertEqual(
+            crawler.autoindex_size_matches('1540000', '1.4M'), None)
+        self.assertEqual(
+            crawler.autoindex_size_matches('1580000', '1.4M'), False)
+
+        # Not a size
+        self.assertEqual(crawler.autoindex_size_matches('1234', '-'), False)
+
+    def test_try_http_index(self):
+        """ Test that try_http_index checks with a HEAD request the files
+        whose size the directory index does not tell apart.
+        """
+        with open(os.path.join(AUTOINDEX_PATH, 'l', 'index.html')) as stream:
+            body = stream.read()
+        d = model.Directory(
+            name='pub/fedora/linux/releases/20/Fedora/source/SRPMS/l',
+            readable=True)
+        checked = []
+
+        def http_get(hoststate, url, headers):
+            return FakeResponse(200, body)
+
+        def check_url(hoststate, url, filedata, recursion, readable):
+            checked.append(url)
+            return filedata['size'] == '639900'
+
+        orig = crawler.http_get, crawler.check_url
+        crawler.http_get, crawler.check_url = http_get, check_url
+        try:
+            url = 'http://mirror.example.com/%s' % d.name
+            d.files = {
+                'LibRaw-0.15.4-1.fc20.src.rpm': {'size': '1468006'},
+                'langtable-0.0.23-1.fc20.src.rpm': {'size': '639900'},
+            }
+            self.assertEqual(
+                crawler.try_http_index(d, crawler.hostState(), url), True)
+            self.assertEqual(
+                checked, [url + '/langtable-0.0.23-1.fc20.src.rpm'])
+
+            # The HEAD request shows another size
+            d.files['langtable-0.0.23-1.fc20.src.rpm'] = {'size': '639800'}
+            self.assertEqual(
+                crawler.try_http_index(d, crawler.hostState(), url), False)
+
+            # Sizes matching the index are not checked
+            del checked[:]
+            d.files['langtable-0.0.23-1.fc20.src.rpm'] = {'size': '638976'}
+            self.assertEqual(
+                crawler.try_http_index(d, crawler.hostState(), url), True)
+            self.assertEqual(checked, [])
+        finally:
+            crawler.http_get, crawler.check_url = orig
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(MMCrawlertests)
+    unittest.TextTestRunner(verbosity=10).run(SUITE)
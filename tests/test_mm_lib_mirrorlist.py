@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the mirrorlist cache builder.
+'''
+
+__requires__ = ['SQLAlchemy >= 0.7']
+import pkg_resources
+
+import cPickle as pickle
+import datetime
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import mirrormanager2.lib
+import mirrormanager2.lib.mirrorlist as mirrorlist
+import tests
+from mirrormanager2.lib import model
+
+
+class StubResolver(object):
+    """ Fake DNS resolver used for the tests. """
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.queries = []
+
+    def __call__(self, name, timeout):
+        self.queries.append(name)
+        answer = self.answers[name]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+class MMLibMirrorlisttests(tests.Modeltests):
+    """ Mirrorlist cache tests. """
+
+    def setUp(self):
+        """ Set up the environnment, ran before every tests. """
+        super(MMLibMirrorlisttests, self).setUp()
+        mirrorlist.global_caches['repo_arch_to_directoryname'] = {}
+        self.tmpdir = tempfile.mkdtemp(prefix='mm2-tests-')
+
+    def tearDown(self):
+        """ Remove the temporary folder. """
+        shutil.rmtree(self.tmpdir)
+        super(MMLibMirrorlisttests, self).tearDown()
+
+    def test_resolve_names(self):
+        """ Test the resolve_names function of
+        mirrormanager2.lib.mirrorlist.
+        """
+        resolver = StubResolver({
+            'mirror.localhost': (['127.0.0.1', '::1'], 600),
+            'empty.localhost': ([], None),
+        })
+        cache = {}
+        results = mirrorlist.resolve_names(
+            ['mirror.localhost', 'empty.localhost'], cache=cache,
+            resolver=resolver)
+        self.assertEqual(
+            sorted(str(ip) for ip in results['mirror.localhost']),
+            ['127.0.0.1', '::1'])
+        self.assertEqual(results['empty.localhost'], [])
+        self.assertEqual(
+            sorted(resolver.queries), ['empty.localhost', 'mirror.localhost'])
+        self.assertTrue(cache['mirror.localhost']['expires'] > time.time())
+
+        # Non-expired entries are not looked up again
+        resolver.queries = []
+        results = mirrorlist.resolve_names(
+            ['mirror.localhost'], cache=cache, resolver=resolver)
+        self.assertEqual(resolver.queries, [])
+        self.assertEqual(len(results['mirror.localhost']), 2)
+
+        # The names no longer used are dropped from the cache
+        self.assertEqual(cache.keys(), ['mirror.localhost'])
+
+    def test_lookup_name_timeout(self):
+        """ Test that the timeout of lookup_name covers both the A and AAAA
+        lookups of the name.
+        """
+        lifetimes = []
+
+        class SlowResolver(object):
+            lifetime = None
+
+            def query(self, name, rdtype):
+                lifetimes.append(self.lifetime)
+                time.sleep(0.3)
+                raise mirrorlist.dns.resolver.NoAnswer()
+
+        resolver = mirrorlist.dns.resolver.Resolver
+        mirrorlist.dns.resolver.Resolver = SlowResolver
+        try:
+            self.assertEqual(
+                mirrorlist.lookup_name('mirror.localhost', timeout=1),
+                ([], None))
+            self.assertRaises(
+                mirrorlist.dns.exception.Timeout,
+                mirrorlist.lookup_name, 'mirror.localhost', timeout=0.2)
+        finally:
+            mirrorlist.dns.resolver.Resolver = resolver
+        self.assertTrue(lifetimes[0] <= 1)
+        self.assertTrue(lifetimes[1] <= 0.7)
+        self.assertEqual(len(lifetimes), 3)
+
+    def test_resolve_names_stale(self):
+        """ Test that resolve_names falls back to expired entries when the
+        lookup fails.
+        """
+        resolver = StubResolver({
+            'mirror.localhost': Exception('Timeout'),
+            'new.localhost': Exception('Timeout'),
+        })
+        cache = {
+            'mirror.localhost': {
+                'ips': ['192.168.0.1'], 'expires': time.time() - 10},
+        }
+        results = mirrorlist.resolve_names(
+            ['mirror.localhost', 'new.localhost'], cache=cache,
+            resolver=resolver)
+        self.assertEqual(
+            [str(ip) for ip in results['mirror.localhost']], ['192.168.0.1'])
+        self.assertEqual(results['new.localhost'], [])
+        self.assertFalse('new.localhost' in cache)
+
+    def test_dns_cache_file(self):
+        """ Test the read_dns_cache and write_dns_cache functions of
+        mirrormanager2.lib.mirrorlist.
+        """
+        filename = os.path.join(self.tmpdir, 'dns_cache.pkl')
+        self.assertEqual(mirrorlist.read_dns_cache(filename), {})
+
+        cache = {'mirror.localhost': {'ips': ['127.0.0.1'], 'expires': 1}}
+        mirrorlist.write_dns_cache(filename, cache)
+        self.assertEqual(mirrorlist.read_dns_cache(filename), cache)
+
+    def test_populate_host_caches_netblock_names(self):
+        """ Test that populate_host_caches resolves the netblocks given as
+        host names through the DNS cache.
+        """
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_hostnetblock(self.session)
+        item = model.HostNetblock(
+            host_id=1,
+            netblock='mirror.localhost',
+            name='by name',
+        )
+        self.session.add(item)
+        self.session.commit()
+
+        filename = os.path.join(self.tmpdir, 'dns_cache.pkl')
+        mirrorlist.write_dns_cache(filename, {
+            'mirror.localhost': {
+                'ips': ['10.0.0.1'], 'expires': time.time() + 3600},
+        })
+
+        mirrorlist.populate_host_caches(
+            self.session, dns_cache_file=filename)
+        cache = mirrorlist.global_caches['host_netblock_cache']
+        self.assertEqual(
+            sorted((str(k), v) for k, v in cache.items()),
+            [('10.0.0.1', [1]), ('192.168.0.0/24', [3])])
+
+    def _create_directory_data(self):
+        """ Create the data needed to build the directory cache. """
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategoryurl(self.session)
+        tests.create_categorydirectory(self.session)
+        tests.create_hostcategorydir(self.session)
+        item = model.HostCategoryUrl(
+            host_category_id=3,
+            url='http://mirror2.localhost/pub/fedora/linux',
+            private=False,
+        )
+        self.session.add(item)
+        self.session.commit()
+
+    def _full_build(self):
+        """ Return the directory cache and repo_arch_to_directoryname of a
+        full build. """
+        mirrorlist.global_caches['repo_arch_to_directoryname'] = {}
+        mirrorlist.populate_directory_cache(self.session)
+        return (
+            mirrorlist.global_caches['mirrorlist_cache'],
+            mirrorlist.global_caches['repo_arch_to_directoryname'])
+
+    def test_build_directory_cache_queries(self):
+        """ Test that build_directory_cache does not query the database once
+        its lookups are loaded.
+        """
+        self._create_directory_data()
+        tests.create_version(self.session)
+        tests.create_repository(self.session)
+        self.session.add(model.CategoryDirectory(
+            directory_id=9,
+            category_id=1,
+        ))
+        self.session.add(model.HostCategoryDir(
+            host_category_id=1,
+            directory_id=9,
+            path='pub/fedora/linux/updates/testing/21/x86_64',
+            up2date=True,
+        ))
+        version = mirrormanager2.lib.get_version_by_name_version(
+            self.session, 'Fedora', '21')
+        version.ordered_mirrorlist = False
+        self.session.add(version)
+        self.session.commit()
+
+        lookups = mirrorlist.setup_directory_lookups(self.session)
+        result = mirrormanager2.lib.query_directories(self.session)
+        self.session.expire_all()
+
+        statements = []
+
+        def count_queries(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.session.get_bind()
+        sqlalchemy.event.listen(
+            engine, 'before_cursor_execute', count_queries)
+        try:
+            cache = {}
+            repo_arch_to_directoryname = {}
+            mirrorlist.build_directory_cache(
+                result, cache, repo_arch_to_directoryname, lookups)
+        finally:
+            sqlalchemy.event.remove(
+                engine, 'before_cursor_execute', count_queries)
+
+        self.assertEqual(statements, [])
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(
+            repo_arch_to_directoryname,
+            {('updates-testing-f21', 'x86_64'):
+                'pub/fedora/linux/updates/testing/21/x86_64'})
+        self.assertFalse(cache[
+            'pub/fedora/linux/updates/testing/21/x86_64'][
+            'ordered_mirrorlist'])
+        self.assertTrue(
+            cache['pub/fedora/linux/releases/21']['ordered_mirrorlist'])
+
+    def test_populate_directory_cache_workers(self):
+        """ Test that populate_directory_cache gives the same results when
+        using several processes.
+        """
+        self._create_directory_data()
+
+        expected_cache, expected_repo_arch = self._full_build()
+        self.assertEqual(len(expected_cache), 3)
+
+        mirrorlist.global_caches['repo_arch_to_directoryname'] = {}
+        mirrorlist.populate_directory_cache(self.session, workers=2)
+        self.assertEqual(
+            mirrorlist.diff_directory_caches(
+                mirrorlist.global_caches['mirrorlist_cache'], expected_cache),
+            [])
+        self.assertEqual(
+            mirrorlist.global_caches['repo_arch_to_directoryname'],
+            expected_repo_arch)
+
+    def test_directory_name_ranges(self):
+        """ Test the directory_name_ranges function of
+        mirrormanager2.lib.mirrorlist.
+        """
+        self.assertEqual(
+            mirrorlist.directory_name_ranges(self.session, 4),
+            [(None, None)])
+
+        tests.create_directory(self.session)
+        ranges = mirrorlist.directory_name_ranges(self.session, 4)
+        self.assertEqual(ranges[0][0], None)
+        self.assertEqual(ranges[-1][1], None)
+        self.assertEqual(len(ranges), 4)
+        # ranges are contiguous
+        for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+
+    def _incremental_build(self, state):
+        """ Run an incremental build and check it matches a full build. """
+        full = mirrorlist.populate_directory_cache_incremental(
+            self.session, state, margin=datetime.timedelta(0))
+        cache = mirrorlist.global_caches['mirrorlist_cache']
+        repo_arch = mirrorlist.global_caches['repo_arch_to_directoryname']
+        expected_cache, expected_repo_arch = self._full_build()
+        self.assertEqual(
+            mirrorlist.diff_directory_caches(cache, expected_cache), [])
+        self.assertEqual(repo_arch, expected_repo_arch)
+        return full, cache
+
+    def test_populate_directory_cache_incremental(self):
+        """ Test the populate_directory_cache_incremental function of
+        mirrormanager2.lib.mirrorlist.
+        """
+        self._create_directory_data()
+
+        state = {}
+        full, cache = self._incremental_build(state)
+        self.assertTrue(full)
+        self.assertEqual(state['generation'], 1)
+        self.assertEqual(
+            cache['pub/fedora/linux/releases/21']['global'], set([1, 2]))
+
+        # Nothing changed
+        full, cache = self._incremental_build(state)
+        self.assertFalse(full)
+        self.assertEqual(state['generation'], 2)
+
+        # A directory is no longer up to date on a host
+        hcd = mirrormanager2.lib.get_hostcategorydir_by_hostcategoryid_and_path(
+            self.session, 3, 'pub/fedora/linux/releases/21')[0]
+        hcd.up2date = False
+        self.session.add(hcd)
+        self.session.commit()
+
+        full, cache = self._incremental_build(state)
+        self.assertFalse(full)
+        self.assertEqual(
+            cache['pub/fedora/linux/releases/21']['global'], set([1]))
+
+        # A host is disabled
+        host = mirrormanager2.lib.get_host(self.session, 1)
+        host.user_active = False
+        self.session.add(host)
+        self.session.commit()
+
+        full, cache = self._incremental_build(state)
+        self.assertFalse(full)
+        self.assertEqual(state['dirty'], 3)
+        self.assertEqual(cache, {})
+
+    def test_populate_directory_cache_incremental_full_rebuild(self):
+        """ Test that populate_directory_cache_incremental does a full build
+        when the last one is too old.
+        """
+        self._create_directory_data()
+
+        state = {}
+        self._incremental_build(state)
+        full = mirrorlist.populate_directory_cache_incremental(
+            self.session, state, full_rebuild_interval=datetime.timedelta(0))
+        self.assertTrue(full)
+
+    def test_diff_caches(self):
+        """ Test the diff_caches function of mirrormanager2.lib.mirrorlist.
+        """
+        old = {
+            'generation': 1,
+            'hcurl_cache': {1: 'http://a', 2: 'http://b'},
+            'disabled_repositories': {},
+            'location_cache': {},
+        }
+        new = {
+            'generation': 2,
+            'hcurl_cache': {1: 'http://a', 2: 'http://c', 3: 'http://d'},
+            'disabled_repositories': {},
+            'location_cache': {},
+            'netblock_country_cache': {'10.0.0.0/8': 'FR'},
+        }
+        self.assertEqual(mirrorlist.diff_caches(old, new), {
+            'hcurl_cache': ('update', {2: 'http://c', 3: 'http://d'}, []),
+            'netblock_country_cache': (
+                'replace', {'10.0.0.0/8': 'FR'}),
+        })
+        self.assertEqual(mirrorlist.diff_caches(new, old), {
+            'hcurl_cache': ('update', {2: 'http://b'}, [3]),
+        })
+
+    def test_dump_caches_delta(self):
+        """ Test that dump_caches writes the delta against the previous
+        generation of the file.
+        """
+        self._create_directory_data()
+        mirrorlist.populate_all_caches(self.session)
+        filename = os.path.join(self.tmpdir, 'mirrorlist_cache.pkl')
+
+        self.assertEqual(
+            mirrorlist.dump_caches(self.session, filename, delta=True), 1)
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)),
+            ['mirrorlist_cache.pkl', 'mirrorlist_cache.pkl.manifest'])
+        base = mirrorlist.read_pickle(filename)
+        base_checksum = mirrorlist.file_checksum(filename)
+
+        host = mirrormanager2.lib.get_host(self.session, 1)
+        host.user_active = False
+        self.session.add(host)
+        self.session.commit()
+        mirrorlist.populate_all_caches(self.session)
+
+        self.assertEqual(
+            mirrorlist.dump_caches(self.session, filename, delta=True), 2)
+        delta = mirrorlist.read_pickle(mirrorlist.delta_filename(filename, 2))
+        self.assertEqual(delta['base_generation'], 1)
+        self.assertEqual(delta['base_checksum'], base_checksum)
+        self.assertEqual(delta['generation'], 2)
+        self.assertEqual(
+            delta['checksum'], mirrorlist.file_checksum(filename))
+        changes = pickle.loads(zlib.decompress(delta['payload']))
+        self.assertEqual(changes.keys(), ['mirrorlist_cache'])
+
+        # Applying the changes to the previous generation gives the new one
+        for key, change in changes.items():
+            if change[0] == 'replace':
+                base[key] = change[1]
+            else:
+                base[key].update(change[1])
+                for k in change[2]:
+                    del base[key][k]
+        base['generation'] = 2
+        self.assertEqual(base, mirrorlist.read_pickle(filename))
+
+        # Only the most recent deltas are kept
+        mirrorlist.dump_caches(
+            self.session, filename, delta=True, keep_deltas=1)
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)),
+            ['mirrorlist_cache.pkl', 'mirrorlist_cache.pkl.delta-3',
+             'mirrorlist_cache.pkl.manifest'])
+        with open(mirrorlist.manifest_filename(filename)) as stream:
+            self.assertEqual(json.load(stream), {
+                'version': mirrorlist.DELTA_VERSION,
+                'generation': 3,
+                'checksum': mirrorlist.file_checksum(filename),
+                'deltas': [3],
+            })
+
+    def test_fetch_caches(self):
+        """ Test that the mirrorlist nodes only download the whole pickle
+        file when the deltas cannot bring theirs up to date.
+        """
+        fetch_cache = imp.load_source('mirrorlist_fetch_cache', os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), '..', 'mirrorlist',
+            'mirrorlist_fetch_cache.py'))
+        master = os.path.join(self.tmpdir, 'master')
+        node = os.path.join(self.tmpdir, 'node')
+        os.mkdir(master)
+        os.mkdir(node)
+        filename = os.path.join(master, 'mirrorlist_cache.pkl')
+        cachefile = os.path.join(node, 'mirrorlist_cache.pkl')
+
+        self._create_directory_data()
+        mirrorlist.populate_all_caches(self.session)
+
+        def new_generation(keep_deltas=10):
+            host = mirrormanager2.lib.get_host(self.session, 1)
+            host.user_active = not host.user_active
+            self.session.add(host)
+            self.session.commit()
+            mirrorlist.populate_all_caches(self.session)
+            mirrorlist.dump_caches(
+                self.session, filename, delta=True, keep_deltas=keep_deltas)
+
+        mirrorlist.dump_caches(self.session, filename, delta=True)
+        self.assertEqual(
+            fetch_cache.fetch_caches(master, cachefile),
+            ['mirrorlist_cache.pkl'])
+        self.assertEqual(fetch_cache.fetch_caches(master, cachefile), [])
+
+        # Only the deltas are downloaded
+        new_generation()
+        new_generation()
+        self.assertEqual(
+            fetch_cache.fetch_caches(master, cachefile),
+            ['mirrorlist_cache.pkl.delta-2', 'mirrorlist_cache.pkl.delta-3'])
+        self.assertEqual(
+            sorted(os.listdir(node)),
+            ['mirrorlist_cache.pkl', 'mirrorlist_cache.pkl.delta-2',
+             'mirrorlist_cache.pkl.delta-3', 'mirrorlist_cache.pkl.manifest'])
+        self.assertEqual(
+            mirrorlist.read_pickle(cachefile)['generation'], 1)
+
+        # The generation of the node is too old for the deltas left
+        new_generation(keep_deltas=1)
+        new_generation(keep_deltas=1)
+        self.assertEqual(
+            fetch_cache.fetch_caches(master, cachefile),
+            ['mirrorlist_cache.pkl'])
+        self.assertEqual(
+            sorted(os.listdir(node)),
+            ['mirrorlist_cache.pkl', 'mirrorlist_cache.pkl.manifest'])
+        self.assertEqual(
+            mirrorlist.read_pickle(cachefile),
+            mirrorlist.read_pickle(filename))
+
+        # The chain of deltas of the node stays within what the master keeps
+        new_generation(keep_deltas=2)
+        self.assertEqual(
+            fetch_cache.fetch_caches(master, cachefile),
+            ['mirrorlist_cache.pkl.delta-6'])
+        new_generation(keep_deltas=2)
+        self.assertEqual(
+            fetch_cache.fetch_caches(master, cachefile),
+            ['mirrorlist_cache.pkl.delta-7'])
+        new_generation(keep_deltas=2)
+        self.assertEqual(
+            fetch_cache.fetch_caches(master, cachefile),
+            ['mirrorlist_cache.pkl'])
+        self.assertEqual(
+            sorted(os.listdir(node)),
+            ['mirrorlist_cache.pkl', 'mirrorlist_cache.pkl.manifest'])
+        self.assertEqual(
+            mirrorlist.read_pickle(cachefile)['generation'], 8)
+
+        # Or within a fixed number
+        new_generation()
+        self.assertEqual(
+            fetch_cache.fetch_caches(master, cachefile, max_deltas=0),
+            ['mirrorlist_cache.pkl'])
+
+    def test_build_report(self):
+        """ Test that the phases and the size of the caches are recorded in
+        the build report.
+        """
+        self._create_directory_data()
+        mirrorlist.reset_build_report()
+        mirrorlist.populate_all_caches(self.session)
+        filename = os.path.join(self.tmpdir, 'mirrorlist_cache.pkl')
+        mirrorlist.dump_caches(self.session, filename, measure_sizes=True)
+
+        phases = [name for name, seconds in mirrorlist.build_report['phases']]
+        self.assertEqual(phases, [
+            'host_caches', 'shrink', 'directory_cache',
+            'repo_redirect_cache', 'country_continent_redirect_cache',
+            'disabled_repositories', 'file_details_cache', 'hcurl_cache',
+            'location_cache', 'netblock_country_cache', 'pickle_dump'])
+
+        sizes = mirrorlist.build_report['sizes']
+        self.assertEqual(sizes['mirrorlist_cache']['entries'], 3)
+        self.assertEqual(sizes['generation']['entries'], 1)
+        self.assertTrue(sizes['mirrorlist_cache']['bytes'] > 0)
+
+    def test_phase_regressions(self):
+        """ Test the phase_regressions function of
+        mirrormanager2.lib.mirrorlist.
+        """
+        previous = [('host_caches', 10), ('shrink', 0.1), ('delta', 1)]
+        current = [
+            ('host_caches', 16), ('shrink', 0.5), ('delta', 1), ('delta', 1),
+            ('pickle_dump', 20)]
+        self.assertEqual(
+            mirrorlist.phase_regressions(previous, current, 0.5),
+            [('delta', 1, 2), ('host_caches', 10, 16)])
+        self.assertEqual(
+            mirrorlist.phase_regressions(previous, current, 1), [])
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(MMLibMirrorlisttests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
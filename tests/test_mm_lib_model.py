@@ -130,6 +130,13 @@ class MMLibModeltests(tests.Modeltests):
         for hc in item.categories:
             for hcd in hc.directories:
                self.assertFalse(hcd.up2date)
+               self.assertEqual(hcd.verified_ctime, None)
+
+        # The directories of the other hosts are left alone
+        item = model.Host.get(self.session, 2)
+        for hc in item.categories:
+            for hcd in hc.directories:
+               self.assertTrue(hcd.up2date)
 
     def test_host_is_active(self):
         """ Test the Host.is_active object of mirrormanager2.lib.model.
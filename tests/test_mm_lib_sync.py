@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 sync tests.
+'''
+
+import unittest
+import shutil
+import sys
+import os
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import mirrormanager2.lib.sync as sync
+
+# An rsync printing a listing, writing its arguments to args, its filter
+# rules to filters and the pid of a child hanging until killed to pid
+FAKE_RSYNC = """#!/bin/sh
+echo "$@" > %(tmpdir)s/args
+for arg in "$@"; do
+    case "$arg" in
+        --filter=merge\ *) cp "${arg#--filter=merge }" %(tmpdir)s/filters;;
+    esac
+done
+echo '-rw-r--r--             10 2014/01/01 10:00:00 README'
+echo '-rw-r--r--           2048 2014/01/01 10:00:00 20/Fedora/a.rpm'
+sleep 60 &
+echo $! > %(tmpdir)s/pid
+wait
+"""
+
+
+def process_running(pid):
+    """ Whether the process is alive, and not a zombie. """
+    try:
+        with open('/proc/%d/status' % pid) as stream:
+            for line in stream:
+                if line.startswith('State:'):
+                    return 'Z' not in line.split()[1]
+    except IOError:
+        return False
+    return True
+
+
+class MMLibSynctests(unittest.TestCase):
+    """ Sync tests. """
+
+    def setUp(self):
+        """ Put a fake rsync first in the PATH. """
+        self.tmpdir = tempfile.mkdtemp()
+        rsync = os.path.join(self.tmpdir, 'rsync')
+        with open(rsync, 'w') as stream:
+            stream.write(FAKE_RSYNC % dict(tmpdir=self.tmpdir))
+        os.chmod(rsync, 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s' % (self.tmpdir, self.path)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmpdir)
+
+    def _hanging_pid(self):
+        """ The pid of the child of the fake rsync, once it started. """
+        filename = os.path.join(self.tmpdir, 'pid')
+        for i in range(100):
+            if os.path.exists(filename):
+                with open(filename) as stream:
+                    content = stream.read().strip()
+                if content:
+                    return int(content)
+            time.sleep(0.05)
+        self.fail('The fake rsync did not start')
+
+    def _wait_exited(self, pid):
+        for i in range(100):
+            if not process_running(pid):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_run_rsync(self):
+        """ Test that the listing of run_rsync is read while rsync runs and
+        that close() kills rsync and its children.
+        """
+        listing = sync.run_rsync(
+            'rsync://mirror.example.com/fedora/', '--no-motd',
+            directories=['20/Fedora'], io_timeout=30)
+        start = time.time()
+        self.assertEqual(
+            listing.readline(),
+            '-rw-r--r--             10 2014/01/01 10:00:00 README\n')
+        self.assertEqual(
+            listing.readline(),
+            '-rw-r--r--           2048 2014/01/01 10:00:00 20/Fedora/a.rpm\n')
+        # rsync still runs
+        self.assertTrue(time.time() - start < 30)
+        self.assertEqual(listing.returncode, None)
+        pid = self._hanging_pid()
+        self.assertTrue(process_running(pid))
+
+        with open(os.path.join(self.tmpdir, 'args')) as stream:
+            args = stream.read()
+        self.assertTrue(args.startswith('--temp-dir=/tmp -r '))
+        self.assertTrue('--timeout=30 --contimeout=30 --no-motd' in args)
+        self.assertTrue(
+            args.endswith(' rsync://mirror.example.com/fedora/\n'))
+        with open(os.path.join(self.tmpdir, 'filters')) as stream:
+            self.assertEqual(
+                stream.read(),
+                '+ /20/\n+ /20/Fedora/\n+ /20/Fedora/*\n- *\n')
+        filters = listing.filters.name
+        self.assertTrue(os.path.exists(filters))
+
+        listing.close()
+        self.assertTrue(listing.returncode < 0)
+        self.assertTrue(self._wait_exited(pid))
+        self.assertFalse(os.path.exists(filters))
+
+    def test_run_rsync_timeout(self):
+        """ Test that a hung rsync is killed after the timeout, along with
+        its children.
+        """
+        start = time.time()
+        listing = sync.run_rsync(
+            'rsync://mirror.example.com/fedora/', timeout=1)
+        lines = list(listing)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(1 <= time.time() - start < 30)
+        self.assertTrue(listing.returncode < 0)
+        self.assertTrue(self._wait_exited(self._hanging_pid()))
+
+    def test_rsync_filters(self):
+        """ Test the rsync_filters function of mirrormanager2.lib.sync. """
+        self.assertEqual(
+            sync.rsync_filters(
+                ['20/Fedora/x86_64/os/repodata', '20/Fedora/x86_64/os/',
+                 '21/Everything/source']),
+            [
+                '+ /20/',
+                '+ /20/Fedora/',
+                '+ /20/Fedora/x86_64/',
+                '+ /20/Fedora/x86_64/os/',
+                '+ /20/Fedora/x86_64/os/*',
+                '+ /20/Fedora/x86_64/os/repodata/',
+                '+ /20/Fedora/x86_64/os/repodata/*',
+                '+ /21/',
+                '+ /21/Everything/',
+                '+ /21/Everything/source/',
+                '+ /21/Everything/source/*',
+                '- *',
+            ]
+        )
+
+        # The top of the listing
+        self.assertEqual(sync.rsync_filters(['']), ['+ /*', '- *'])
+
+        # Wildcards in the directory names are escaped
+        self.assertEqual(
+            sync.rsync_filters(['a[1]']),
+            ['+ /a\\[1]/', '+ /a\\[1]/*', '- *'])
+
+        # Nothing is listed without directories
+        self.assertEqual(sync.rsync_filters([]), ['- *'])
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(MMLibSynctests)
+    unittest.TextTestRunner(verbosity=10).run(SUITE)
@@ -7,6 +7,7 @@ mirrormanager2 tests.
 __requires__ = ['SQLAlchemy >= 0.7']
 import pkg_resources
 
+import datetime
 import unittest
 import sys
 import os
@@ -39,6 +40,102 @@ class MMLibtests(tests.Modeltests):
         results = mirrormanager2.lib.query_directories(self.session)
         self.assertEqual(len(results), 12)
 
+        results = mirrormanager2.lib.query_directories(
+            self.session, directory_ids=[4])
+        self.assertEqual(len(results), 4)
+        self.assertEqual(
+            set(r.dname for r in results),
+            set(['pub/fedora/linux/releases/20']))
+
+        results = mirrormanager2.lib.query_directories(
+            self.session, host_ids=[2])
+        self.assertEqual(len(results), 0)
+
+    def test_iter_directories(self):
+        """ Test the iter_directories function of mirrormanager2.lib.
+        """
+        results = list(mirrormanager2.lib.iter_directories(self.session))
+        self.assertEqual(results, [])
+
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategoryurl(self.session)
+        tests.create_categorydirectory(self.session)
+
+        expected = [
+            tuple(row)
+            for row in mirrormanager2.lib.query_directories(self.session)]
+        results = list(mirrormanager2.lib.iter_directories(
+            self.session, batch_size=5))
+        self.assertEqual(len(results), 12)
+        self.assertEqual(results, expected)
+        self.assertTrue(all(type(row) is tuple for row in results))
+
+        results = list(mirrormanager2.lib.iter_directories(
+            self.session, directory_ids=[4]))
+        self.assertEqual(
+            set(row[1] for row in results),
+            set(['pub/fedora/linux/releases/20']))
+
+    def test_query_host_settings(self):
+        """ Test the query_host_settings function of mirrormanager2.lib.
+        """
+        results = mirrormanager2.lib.query_host_settings(self.session)
+        self.assertEqual(len(results), 0)
+
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategoryurl(self.session)
+
+        results = mirrormanager2.lib.query_host_settings(self.session)
+        # 4 urls for host 1's first category, 1 row per other host category
+        # and 1 for the host without category
+        self.assertEqual(len(results), 8)
+        self.assertEqual(results[0].hostid, 1)
+        self.assertEqual(results[0].host_category_url_id, 1)
+        self.assertEqual(results[-1].hostid, 3)
+        self.assertEqual(results[-1].host_category_id, None)
+
+    def test_get_hostcategorydir_updated_since(self):
+        """ Test the get_hostcategorydir_updated_since function of
+        mirrormanager2.lib.
+        """
+        start = datetime.datetime.utcnow()
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategorydir(self.session)
+
+        results = mirrormanager2.lib.get_hostcategorydir_updated_since(
+            self.session, start)
+        self.assertEqual(sorted(results), [(4, 1), (5, 2)])
+
+        start = datetime.datetime.utcnow()
+        results = mirrormanager2.lib.get_hostcategorydir_updated_since(
+            self.session, start)
+        self.assertEqual(results, [])
+
+        hcd = mirrormanager2.lib.get_hostcategorydir_by_hostcategoryid_and_path(
+            self.session, 3, 'pub/fedora/linux/releases/21')[0]
+        hcd.up2date = False
+        self.session.add(hcd)
+        self.session.commit()
+
+        results = mirrormanager2.lib.get_hostcategorydir_updated_since(
+            self.session, start)
+        self.assertEqual(results, [(5, 2)])
+
     def test_get_site(self):
         """ Test the get_site function of mirrormanager2.lib. """
         tests.create_site(self.session)
@@ -566,6 +663,22 @@ class MMLibtests(tests.Modeltests):
         self.assertEqual(
             results[1].directory.name, 'pub/epel')
 
+    def test_get_category_topdirs(self):
+        """ Test the get_category_topdirs function of mirrormanager2.lib.
+        """
+        results = mirrormanager2.lib.get_category_topdirs(self.session)
+        self.assertEqual(results, [])
+
+        tests.create_base_items(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+
+        results = mirrormanager2.lib.get_category_topdirs(self.session)
+        self.assertEqual(
+            [tuple(row) for row in results],
+            [(1, 'pub/fedora/linux/releases'),
+             (2, 'pub/fedora/linux/extras')])
+
     def test_get_product_by_name(self):
         """ Test the get_product_by_name function of mirrormanager2.lib.
         """
@@ -950,6 +1063,30 @@ class MMLibtests(tests.Modeltests):
         self.assertEqual(results[0].name, 'mirror2.localhost')
         self.assertEqual(results[1].name, 'mirror.localhost')
 
+    def test_get_host_up2date_counts(self):
+        """ Test the get_host_up2date_counts function of mirrormanager2.lib.
+        """
+        results = mirrormanager2.lib.get_host_up2date_counts(self.session)
+        self.assertEqual(results, [])
+
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategorydir(self.session)
+
+        results = mirrormanager2.lib.get_host_up2date_counts(self.session)
+        self.assertEqual(results, [(1, 1, 1), (2, 1, 1)])
+
+        mirrormanager2.lib.set_hostcategorydirs_up2date(
+            self.session, [2], False)
+        self.session.commit()
+
+        results = mirrormanager2.lib.get_host_up2date_counts(self.session)
+        self.assertEqual(results, [(1, 1, 1), (2, 1, 0)])
+
     def test_get_user_sites(self):
         """ Test the get_user_sites function of mirrormanager2.lib.
         """
@@ -996,6 +1133,29 @@ class MMLibtests(tests.Modeltests):
             results.name, 'pub/fedora/linux/updates/testing/19/x86_64')
         self.assertEqual(results.readable, True)
 
+    def test_get_directory_ids_under(self):
+        """ Test the get_directory_ids_under function of mirrormanager2.lib.
+        """
+        results = mirrormanager2.lib.get_directory_ids_under(
+            self.session, 'pub/fedora/linux/releases')
+        self.assertEqual(results, [])
+
+        tests.create_directory(self.session)
+
+        results = mirrormanager2.lib.get_directory_ids_under(
+            self.session, 'pub/fedora/linux/releases')
+        self.assertEqual(
+            sorted(results),
+            [
+                ('pub/fedora/linux/releases', 1),
+                ('pub/fedora/linux/releases/20', 4),
+                ('pub/fedora/linux/releases/21', 5),
+            ])
+
+        results = mirrormanager2.lib.get_directory_ids_under(
+            self.session, 'pub/epel')
+        self.assertEqual(results, [('pub/epel', 3)])
+
     def test_get_directories(self):
         """ Test the get_directories function of mirrormanager2.lib.
         """
@@ -1010,6 +1170,20 @@ class MMLibtests(tests.Modeltests):
         self.assertEqual(results[1].name, 'pub/fedora/linux/extras')
         self.assertEqual(results[2].name, 'pub/epel')
 
+    def test_get_directory_names(self):
+        """ Test the get_directory_names function of mirrormanager2.lib.
+        """
+        results = mirrormanager2.lib.get_directory_names(self.session)
+        self.assertEqual(results, [])
+
+        tests.create_directory(self.session)
+
+        results = mirrormanager2.lib.get_directory_names(self.session)
+        self.assertEqual(len(results), 9)
+        self.assertEqual(results, sorted(results))
+        self.assertEqual(
+            results[0], 'pub/archive/fedora/linux/releases/20/Fedora/source')
+
     def test_get_directory_by_id(self):
         """ Test the get_directory_by_id function of mirrormanager2.lib.
         """
@@ -1056,6 +1230,111 @@ class MMLibtests(tests.Modeltests):
         self.assertEqual(
             results[0].host_category.category.name, 'Fedora Linux')
 
+    def test_get_hostcategorydir_by_hostcategoryid_and_suffixes(self):
+        """ Test the get_hostcategorydir_by_hostcategoryid_and_suffixes
+        function of mirrormanager2.lib.
+        """
+        results = mirrormanager2.lib.\
+            get_hostcategorydir_by_hostcategoryid_and_suffixes(
+                self.session, 3, ['/21', '/iso'])
+        self.assertEqual(results, [])
+
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategorydir(self.session)
+
+        results = mirrormanager2.lib.\
+            get_hostcategorydir_by_hostcategoryid_and_suffixes(
+                self.session, 3, ['/21', '/iso'])
+        self.assertEqual(len(results), 1)
+        self.assertEqual(
+            results[0].directory.name, 'pub/fedora/linux/releases/21')
+
+        results = mirrormanager2.lib.\
+            get_hostcategorydir_by_hostcategoryid_and_suffixes(
+                self.session, 1, ['/21', '/iso'])
+        self.assertEqual(results, [])
+
+    def test_get_hostcategorydirs_by_hostcategoryids(self):
+        """ Test the get_hostcategorydirs_by_hostcategoryids function of
+        mirrormanager2.lib.
+        """
+        results = mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+            self.session, [1, 3])
+        self.assertEqual(results, [])
+
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategorydir(self.session)
+
+        results = mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+            self.session, [1, 3])
+        self.assertEqual(
+            sorted(tuple(row) for row in results),
+            [
+                (1, 1, 'pub/fedora/linux/releases/20', True, 4, None, True),
+                (2, 3, 'pub/fedora/linux/releases/21', True, 5, None, True),
+            ])
+
+        results = mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+            self.session, [2])
+        self.assertEqual(results, [])
+
+    def test_add_and_set_hostcategorydirs_up2date(self):
+        """ Test the add_hostcategorydirs and set_hostcategorydirs_up2date
+        functions of mirrormanager2.lib.
+        """
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_category(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategorydir(self.session)
+
+        mirrormanager2.lib.add_hostcategorydirs(self.session, [dict(
+            host_category_id=3, path='pub/fedora/linux/releases',
+            directory_id=1, up2date=False, verified_ctime=None)])
+        mirrormanager2.lib.set_hostcategorydirs_up2date(
+            self.session, [1, 2], False, chunk_size=1)
+        self.session.commit()
+
+        results = mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+            self.session, [1, 3])
+        self.assertEqual(
+            sorted((row.id, row.up2date) for row in results),
+            [(1, False), (2, False), (3, False)])
+
+        mirrormanager2.lib.set_hostcategorydirs_up2date(
+            self.session, [1, 2, 3], True, verified_ctimes={2: 10, 3: 20},
+            chunk_size=2)
+        self.session.commit()
+
+        results = mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+            self.session, [1, 3])
+        self.assertEqual(
+            sorted((row.id, row.up2date, row.verified_ctime)
+                   for row in results),
+            [(1, True, None), (2, True, 10), (3, True, 20)])
+
+        mirrormanager2.lib.set_hostcategorydirs_directory(
+            self.session, {1: 2, 3: 4}, chunk_size=1)
+        self.session.commit()
+
+        results = mirrormanager2.lib.get_hostcategorydirs_by_hostcategoryids(
+            self.session, [1, 3])
+        self.assertEqual(
+            sorted((row.id, row.directory_id) for row in results),
+            [(1, 2), (2, 5), (3, 4)])
+
     def test_get_directory_exclusive_host(self):
         """ Test the get_directory_exclusive_host function of
         mirrormanager2.lib.
@@ -165,6 +165,8 @@ install -m 644 mirrorlist/mirrorlist_server.py \
     $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/mirrorlist_server.py
 install -m 644 mirrorlist/weighted_shuffle.py \
     $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/weighted_shuffle.py
+install -m 644 mirrorlist/mirrorlist_fetch_cache.py \
+    $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/mirrorlist_fetch_cache.py
 
 # Install the createdb script
 install -m 644 createdb.py \
@@ -210,6 +212,7 @@ cp -r utility/zebra-dump-parser $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/
 %{_datadir}/mirrormanager2/mirrorlist_client.wsgi
 %{_datadir}/mirrormanager2/mirrorlist_server.py*
 %{_datadir}/mirrormanager2/weighted_shuffle.py*
+%{_datadir}/mirrormanager2/mirrorlist_fetch_cache.py*
 
 
 %files crawler